@@ -2,24 +2,142 @@
 import serial
 import sys, os
 import threading
+import queue
+import argparse
+import importlib
+import json
+import struct
+import glob, hashlib, tempfile, shutil
+import concurrent.futures
+import collections, csv
+import statistics
+import zlib, binascii
+import cProfile, pstats
+import traceback
+try:
+   import readline # Tab completion in the keyboard thread
+except ImportError: # Not available on all platforms e.g. Windows
+   readline = None
 from device328p import MCUREGS 
 from time import *
 
-portName = "/dev/ttyACM0"
+portName = "/dev/ttyACM0" # Default port and speed. Can be set in the config file or on the command line
 portSpeed = "38400"
 
-try:
-   open(portName)
-except (FileNotFoundError):
-   print("Could not open serial port: Ensure Forth system is connected to serial port and port name is correct")
-   exit()
+def open_port(name,speed):
+   ''' Open the serial port to the Forth system. Returns None if the port can't be opened.
+      The name can be a local device e.g. /dev/ttyACM0, or a URL for a network serial server
+      e.g. socket://host:port (raw TCP, as ser2net) or rfc2217://host:port (telnet RFC 2217).
+   '''
+   if is_url(name):
+      try:
+         return serial.serial_for_url(name, int(speed), timeout=0.1, writeTimeout=1.0, rtscts=False, xonxoff=False)
+      except (serial.SerialException, ValueError) as e:
+         print("Could not connect to serial server:",name,"-",e)
+         return None
+   try:
+      open(name)
+   except (FileNotFoundError):
+      print("Could not open serial port: Ensure Forth system is connected to serial port and port name is correct")
+      return None
+   return serial.Serial(name, int(speed), timeout=0.1, writeTimeout=1.0, rtscts=False, xonxoff=False)
+
+def is_url(name):
+   ''' True if the port name is a URL such as socket://host:port rather than a local device '''
+   return "://" in name
+
+def config_port(configFile,name,speed):
+   ''' The serial port has to be open before the config file is uploaded, so look for any
+      '#port' and '#speed' commands in the config file first. Returns (name,speed).
+   '''
+   if os.path.isfile(configFile):
+      with open(configFile, 'rb') as f:
+         for line in f.read().decode('utf-8').splitlines():
+            current_line = LineProcessor(line)
+            if current_line.is_command and len(current_line.text.split()) > 1:
+               command,arg = current_line.text.split()[:2]
+               if command == "#port":
+                  name = arg
+               elif command == "#speed":
+                  speed = arg
+   return name,speed
+
+def hex_convert_file(pathfile,cleanDigest=None):
+   ''' Worker for '#hex', run in a separate process. Converts upper case hex literals in
+      one file. Skips the file if its SHA-1 is 'cleanDigest', i.e. nothing to convert last
+      time. Returns (changed, SHA-1 of the converted file, error message or None).
+   '''
+   tmpName = None # Removed unless it replaced the file
+   try:
+      digest = hashlib.sha1()
+      with open(pathfile, 'rb') as f:
+         for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+      if cleanDigest == digest.hexdigest():
+         return (False,cleanDigest,None)
+
+      changed = False
+      newDigest = hashlib.sha1()
+      with open(pathfile, 'rb') as f, tempfile.NamedTemporaryFile(dir=os.path.dirname(pathfile) or ".",prefix=".",suffix=".hex",delete=False) as tmp:
+         tmpName = tmp.name
+         for line in f:
+            current_line = LineProcessor(line.decode('utf-8'))
+            current_line.hex_convert()
+            newLine = (current_line.text + "\n").encode('utf-8')
+            changed = changed or newLine != line
+            newDigest.update(newLine)
+            tmp.write(newLine)
+      if changed:
+         shutil.copymode(pathfile,tmp.name)
+         os.replace(tmp.name,pathfile) # Atomic, the file is either old or new
+         tmpName = None
+      return (changed,newDigest.hexdigest(),None)
+
+   except (IOError,UnicodeDecodeError) as e: # Reported and the file skipped
+      return (False,None,str(e))
+   finally:
+      if tmpName:
+         try:
+            os.remove(tmpName)
+         except OSError:
+            pass
 
-serial_port = serial.Serial(portName, portSpeed, timeout=0.1, writeTimeout=1.0, rtscts=False, xonxoff=False)
- 
 class ForthTalk():
  
-   def __init__(self):
+   def __init__(self,port=portName,speed=portSpeed,configFile="config.ftk",record=None,replay=None,replayFast=False,log=None,batch=None):
+      self.portName = port # Serial port connected to the Forth system
+      self.baseSpeed = int(speed) # Speed the Forth system starts at after a reset or warm start
+      if replay: # No Forth system, replay a recorded session instead
+         self.portName = replay
+         try:
+            self.serial_port = TracePort(replay,self.baseSpeed,not replayFast)
+         except (IOError,ValueError) as e:
+            print("Could not replay trace file:",e)
+            sys.exit(2)
+      else:
+         self.serial_port = open_port(self.portName,self.baseSpeed)
+      if not self.serial_port:
+         sys.exit(2)
+      if record: # Record all data sent and received
+         try:
+            self.serial_port = TraceRecorder(self.serial_port,record)
+         except IOError as e:
+            print("Could not open trace file:",e)
+            self.serial_port.close()
+            sys.exit(2)
       self.exit = False # Exit the program if True
+      self.batch = batch # Commands and files to run without the keyboard (headless), or None
+      self.errors = 0 # Number of commands or uploads that have failed
+      self.progressStream = None # Machine readable progress log in batch mode
+      self.progressLines = 50 # Lines sent between progress log entries in batch mode
+      self.startTime = monotonic()
+      try:
+         self.sessionLog = open(log,'a') if log else None # Optional complete log of everything received
+      except IOError as e:
+         print("Could not open log file:",e)
+         sys.exit(2)
+      self.terminal = TerminalRenderer(sys.stdout) # Terminal output thread so a slow terminal can't hold up receiving
+      self.logLock = threading.Lock() # Held while writing to, or changing, the session log
       self.displayOutput = False # Display received data to terminal if True
       self.command_args = "" # Last '#' command argument(s), if any
       self.pathList = [] # List of paths to be searched for files
@@ -33,25 +151,186 @@ class ForthTalk():
       self.unknownWords = [] # Populated with undefined words when analysing files
       self.compileFiles = [] # List of files to be compiled, i.e. sent to the Forth system
       self.wordFiles = {}
-      self.configFile = "config.ftk" # Optional file of startup commands (typ. #path commands)
-
+      self.fileIndex = {} # Full path of each file found by '#defs' below the pathList, by file name
+      self.fileTimes = {} # Modification time of each file found by '#defs', by full path
+      self.fileWords = {} # Words defined in each file found by '#defs', by file name
+      self.fileUses = {} # Words used in each file found by '#defs', by file name
+      self.uploadOrder = [] # File names in the order they were last uploaded
+      self.watchStop = None # threading.Event to stop the '#watch' thread, None if not watching
+      self.watchInterval = 1.0 # Seconds between checks for changed files
+      self.dictionaryStart = None # Start of the user flash dictionary, read after '#empty'
+      self.snapshotBlock = 128 # Bytes read per line by '#snapshot'
+      self.restorePause = 0.01 # Pause after each 128 bytes written by '#restore' for flash writes
+      self.blockMode = False # '#block' upload in progress, lines are sent in frames through the loader
+      self.loaderInstalled = False # Loader words are known to be on the Forth system
+      self.loaderActive = False # Forth system is running the loader, reading frames
+      self.blockSize = 95 # Maximum payload bytes per frame, the loader's buffer is 96 bytes
+      self.blockBatch = 4 # Frames sent before waiting for an acknowledgement
+      self.blockTimeout = 2.0 # Seconds to wait for an acknowledgement before sending a batch again
+      self.blockRetries = 5 # Times a batch is sent again without progress before the upload is stopped
+      self.blockLines = [] # Lines waiting to be packed into the next frame
+      self.blockFrames = [] # Lines in each frame of the batch being sent, the first has sequence number blockSeq
+      self.blockSeq = 0 # Sequence number of the first unacknowledged frame
+      self.blockReplies = queue.Queue() # (ack, sequence) replies from the loader, put by _serial_receive
+      self.blockPending = b"" # ACK or NAK received without its sequence number yet
+      self.blockStats = collections.Counter() # Frames, bytes and frames sent again by '#block'
+      self.wordIndex = WordTrie(MCUREGS) # Prefix index of definedWords, wordFiles and MCUREGS for '#find' and tab completion
+      self.completions = [] # Current tab completion matches
+      self.configFile = configFile # Optional file of startup commands (typ. #path commands)
+      self.startup = False # True while the config file is uploaded
+      self.errorLine = "" # Last error response from the Forth system e.g. 'foo ?'
+      self.onError = "stop" # Action on a compile error during upload: 'stop', 'rollback' or 'continue'
+      self.uploadDepth = 0 # Nesting level of file uploads (files can '#send' other files)
+      self.uploadAborted = False # Set when an upload is stopped by a compile error
+      self.lastMarker = "" # Last 'marker' word sent during an upload, used to roll back on error
+      self.markers = set() # Every 'marker' word sent during uploads, '#block' sends lines running one as text
+      self.sentLines = [] # FIFO buffer of recently sent file lines: (file, line number, source, text)
+      self.uploadQueueSize = 64 # Maximum preprocessed lines read ahead of the serial port during an upload
+      self.linesReceived = 0 # Total lines received, used to pick out replies to queries
+      self.cpuClock = 16000000 # Forth system CPU clock in Hz, used to calculate baud rate divisors
+      self.baudRates = [57600,76800,115200,230400,250000,500000,1000000] # Speeds tried by '#baud'
+      self.maxBaudError = 0.02 # Largest acceptable difference between requested and actual baud rate
+      self.baudHistory = [] # Speeds negotiated by '#baud', the last one is the current speed
+      self.linkTests = 5 # Number of echo tests run after changing speed
+      self.rxErrors = 0 # Corrupt characters received since the last speed change, for link tests
+      self.maxRxErrors = 8 # Fall back to the previous speed when this many corrupt characters ...
+      self.maxRxErrorRate = 0.01 # ... at this rate or more are received within rxErrorWindow
+      self.rxErrorWindow = 10.0 # Seconds over which the receive error rate is measured
+      self.rxHistory = collections.deque() # (time, characters, corrupt characters) received in the window
+      self.baudFallback = False # Set by the receive thread when the link has too many errors
+      self.uartDivisor = 16 # Forth system UART baud rate divisor: 8 in double speed mode
+      # Flow control. 'newline': wait for NL after each line, 'xon': stream using XON/XOFF,
+      # 'window': up to 'sendWindow' lines in flight, hiding the round trip to network serial servers
+      self.flowControl = "window" if is_url(self.portName) else "newline"
+      self.sendWindow = 4 # Lines sent without a response in 'window' flow control mode
+      self.windowTimeout = 1.0 # Time to wait for a response before assuming it was missed
+      self.linesSent = 0 # Lines sent in 'window' flow control mode
+      self.windowBase = 0 # linesReceived - linesSent when nothing is in flight
+      self.xon = threading.Event() # Cleared when XOFF is received from the Forth system, set on XON
+      self.xon.set()
+      self.xoffTimeout = 5.0 # Maximum time to wait for XON before sending anyway
+      self.flowChunk = 16 # Bytes sent between checks for XOFF in 'xon' flow control mode
+      self.lastReceived = 0.0 # Time (monotonic) data was last received from the Forth system
+      self.hexWorkers = os.cpu_count() or 4 # Files converted at the same time by '#hex'
+      self.hexClean = {} # SHA-1 of files '#hex' found nothing to convert in, by filename
+      self.sendLock = threading.RLock() # Held while sending so background queries don't interleave
+      self.telemetry = collections.deque(maxlen=1000) # Free memory samples: (time, flash, eeprom, ram)
+      self.telemetryInterval = 10.0 # Seconds between free memory samples
+      self.telemetryIdle = 1.0 # Only sample when nothing has been received for this many seconds
+      self.telemetryStop = None # threading.Event to stop the sampler thread, None if not running
+      self.definitionOpen = False # A ':' definition has been sent without its ';', the Forth system is compiling
+      self.footprint = None # Footprint profiling during uploads: None (off), 'files' or 'words'
+      self.footprintFiles = {} # Memory used by each file uploaded: {file: {memory: bytes}}
+      self.footprintWords = {} # Memory used by each definition: {file: {word(s): {memory: bytes}}}
+      self.footprintStack = [] # Files being uploaded: [file, free memory before, used by included files]
+      self.footprintDefinition = None # Definition being profiled: (word(s), free memory before)
+      self.wideRegisters = ["TCNT1","ICR1","OCR1A","OCR1B"] # 16 bit registers, read with '@' not 'c@'
+      # Timer counters with their control register and prescaler for each clock select value
+      self.timerPrescalers = {"TCNT0":("TCCR0B",[0,1,8,64,256,1024]),
+                              "TCNT1":("TCCR1B",[0,1,8,64,256,1024]),
+                              "TCNT2":("TCCR2B",[0,1,8,32,64,128,256,1024])}
+      self.timeTimeout = 10.0 # Maximum time for '#time' to run a word N times
+      self.profiling = False # Profile each command run if True
+      self.profileActive = False # True while a command is being profiled
+      self.profiles = [] # Profiled commands: (command, wall time, host CPU, serial wait, pstats.Stats)
+      self.readAheadProfiles = [] # Profiles of read ahead threads during the command being profiled
+      self.readAheadCPU = 0.0 # CPU time of read ahead threads during the command being profiled
+      self.waitTimes = collections.defaultdict(float) # Time spent waiting on the serial port, by thread
+
+      if self.batch != None: # Headless, the caller runs run_batch()
+         return
       # Start the keyboard/serial thread and the serial receive thread
       self.serial_receive() # Start the serial receive/terminal output thread
       self.keybd_serial_send() # Start the keyboard/serial send thread
       self.waitNewline(3,0.3) # Wait for Forth system to start up - 3 x NL or 0.3 seconds
       if os.path.isfile(self.configFile): # Upload config file, if there is one
+         self.startup = True
          self.file_upload(self.configFile)
+         self.startup = False
       self.displayOutput = True # Turn on the serial output display
       self.memory_stats() # Print current memory statistics
 
       
 
+   def profile_command(self,text):
+      ''' Run a command with the profiler on. The wall time is split into host CPU time (this
+         thread and any read ahead threads) and time spent waiting on the serial port.
+      '''
+      self.profileActive = True
+      self.readAheadProfiles = []
+      self.readAheadCPU = 0.0
+      ident = threading.get_ident()
+      waitStart = self.waitTimes[ident]
+      start = monotonic()
+      cpu = thread_time()
+      profiler = cProfile.Profile()
+      profiler.enable()
+      try:
+         self.run_command(text)
+      finally:
+         profiler.disable()
+         self.profileActive = False
+      wall = monotonic() - start
+      cpu = thread_time() - cpu + self.readAheadCPU
+      wait = self.waitTimes[ident] - waitStart
+      stats = pstats.Stats(profiler)
+      for readAhead in self.readAheadProfiles:
+         stats.add(readAhead)
+      self.profiles.append((text,wall,cpu,wait,stats))
+      print("Profile {}: {} - wall {:.3f}s, host CPU {:.3f}s (read ahead {:.3f}s), serial wait {:.3f}s".format(
+         len(self.profiles),text,wall,cpu,self.readAheadCPU,wait))
+
+   def run_batch(self):
+      ''' Headless mode for scripted runs. Runs each '#' command or uploads each file in
+         self.batch in turn, without the keyboard thread or terminal display, and exits with
+         status 0 if everything succeeded or 1 at the first failure. A progress log of one JSON
+         object per line is written to stdout; anything else printed goes to stderr.
+      '''
+      self.progressStream = sys.stdout
+      sys.stdout = sys.stderr # Keep stdout for the progress log
+      self.serial_receive()
+      try:
+         self.progress("start",port=self.portName,speed=self.serial_port.baudrate)
+         self.send_data("") # Get a prompt, returns as soon as it's received
+         if os.path.isfile(self.configFile):
+            self.startup = True
+            self.file_upload(self.configFile)
+            self.startup = False
+         for item in self.batch:
+            if self.errors:
+               break
+            command = item if item.startswith("#") else "#send " + item
+            self.progress("command",command=command)
+            with self.sendLock:
+               self.run_command(command)
+      except Exception as e: # Always exit with a status, whatever went wrong
+         traceback.print_exc()
+         self.errors += 1
+         self.progress("error",message=repr(e))
+      finally:
+         self.exit = True # Stop the receive thread
+      status = 1 if self.errors else 0
+      self.progress("done",status=status,errors=self.errors)
+      sys.exit(status)
+
+   def progress(self,event,**fields):
+      ''' Write a progress log entry in batch mode '''
+      if self.progressStream:
+         entry = {"time":round(monotonic() - self.startTime,3),"event":event}
+         entry.update(fields)
+         self.progressStream.write(json.dumps(entry) + "\n")
+         self.progressStream.flush()
+
    def _keybd_serial_send(self):
       ''' Thread for receiving input from keyboard and either forward to Forth system serial port
          or, if there is a command preceded by '#', executing the command.
          '##' terminates the program.
       '''
       print("Keyboard thread started")
+      if readline:
+         readline.set_completer(self.complete)
+         readline.set_completer_delims(" \t\n")
+         readline.parse_and_bind("tab: complete")
       try:
          while self.exit == False: # Keep running unless self.exit is True
             keybd_input = input()
@@ -61,32 +340,97 @@ class ForthTalk():
             else:
                
                current_line = LineProcessor(keybd_input) # Pass the line to LineProcessor object
-               if current_line.is_command:
-                  self.run_command(current_line.text) # If it's a command, run it
-               else:
-                  # Move up one line and output spaces so echo overwrites input
-                  sys.stdout.write('\r\033\133\101                                               \r') 
-                  sys.stdout.flush()
-                  current_line.substitute_registers() # Substitute register names with literals
-                  current_line.hex_convert() # Convert upper case hex to lower case
-                  self.send_data(current_line.text) # Send it to the Forth system
+               with self.sendLock:
+                  if current_line.is_command:
+                     self.run_command(current_line.text) # If it's a command, run it
+                  else:
+                     # Move up one line and output spaces so echo overwrites input
+                     self.terminal.write('\r\033\133\101                                               \r') 
+                     current_line.substitute_registers() # Substitute register names with literals
+                     current_line.hex_convert() # Convert upper case hex to lower case
+                     self.send_data(current_line.text) # Send it to the Forth system
 
       except (KeyboardInterrupt,EOFError):
          print("InputError")
          self.running = False
       print("Keyboard thread stopped!")
 
+   def complete(self,text,state):
+      ''' readline completer: returns the state'th word starting with text '''
+      if state == 0:
+         self.completions = self.wordIndex.find(text)
+      return self.completions[state] if state < len(self.completions) else None
+
    def keybd_serial_send(self):
       ''' Start keyboard serial thread '''
       threading.Thread(target=self._keybd_serial_send).start()
 
    def send_data(self,sendBuffer):
       ''' Send data to Forth system followed by NL and wait for NL received or timeout '''
-      serial_port.write((sendBuffer + "\n").encode('utf-8'))
-      serial_port.flush()
+      self.track_definition(sendBuffer)
+      if self.baudFallback: # Too many receive errors at the current speed
+         self.baud_fall_back()
+      if self.flowControl == "xon":
+         self.send_xon((sendBuffer + "\n").encode('utf-8'))
+         return
+      if self.flowControl == "window":
+         self.send_window((sendBuffer + "\n").encode('utf-8'))
+         return
+      start = monotonic()
+      self.serial_port.write((sendBuffer + "\n").encode('utf-8'))
+      self.serial_port.flush()
+      self.serial_wait(start)
       # Wait for Forth system to process line sent
       self.waitNewline(1,0.3) # 1 x NL or 0.3 seconds
 
+   def track_definition(self,text):
+      ''' Note whether a line sent leaves a ':' definition open, e.g. typed a line at a time,
+         as the Forth system would compile anything else sent, such as telemetry queries.
+      '''
+      for word in text.split():
+         if word == "\\": # Rest of the line is a comment
+            break
+         if word in (":",":noname"):
+            self.definitionOpen = True
+         elif word in (";",";i"):
+            self.definitionOpen = False
+
+   def send_xon(self,data):
+      ''' Send data in small chunks, pausing while the Forth system has sent XOFF. There is
+         no wait for a response, so lines are streamed as fast as the Forth system allows.
+      '''
+      start = monotonic()
+      for i in range(0,len(data),self.flowChunk):
+         if not self.xon.wait(self.xoffTimeout):
+            sys.stderr.write('--- No XON received after {} seconds ---\n'.format(self.xoffTimeout))
+            self.xon.set()
+         self.serial_port.write(data[i:i+self.flowChunk])
+         self.serial_port.flush() # Wait until sent so no more than one chunk follows an XOFF
+      self.serial_wait(start)
+
+   def send_window(self,data):
+      ''' Send data without waiting for a response unless 'sendWindow' lines are already in
+         flight, i.e. sent but not yet answered with a NL. Over a network serial server this
+         keeps the link busy instead of waiting a round trip for every line. The server should
+         be set up for XON/XOFF (e.g. ser2net XONXOFF) so it paces the serial side, and any
+         XOFF that does reach forthtalk is honoured as well.
+      '''
+      start = monotonic()
+      deadline = start + self.windowTimeout
+      while True:
+         inFlight = self.linesSent - (self.linesReceived - self.windowBase)
+         if inFlight < 0: # More lines received than sent e.g. output from 'words'
+            self.windowBase = self.linesReceived - self.linesSent
+         if inFlight < self.sendWindow and self.xon.is_set():
+            break
+         if monotonic() > deadline: # A response has been missed, start counting again
+            self.windowBase = self.linesReceived - self.linesSent
+            break
+         sleep(0.005)
+      self.serial_port.write(data)
+      self.linesSent += data.count(b"\n")
+      self.serial_wait(start)
+
    def _serial_receive(self):
       ''' Thread to receive serial data from Forth system, maintaining a list of up to
          'self.maxLastLines' (Default=10) last lines received. Received lines are
@@ -96,24 +440,48 @@ class ForthTalk():
       print("Receive thread started")
       recvBuffer = ""
       while self.exit == False:  # Keep looping unless '##'' (exit) received
-         serialInput = serial_port.read(serial_port.in_waiting or 1).decode('utf-8')
+         serialInput = self.serial_port.read(self.serial_port.in_waiting or 1)
+         if serialInput:
+            self.lastReceived = monotonic()
+         if b"\x11" in serialInput or b"\x13" in serialInput: # XON or XOFF
+            serialInput = self.flow_control(serialInput)
+         if self.loaderActive and (b"\x06" in serialInput or b"\x15" in serialInput or self.blockPending):
+            serialInput = self.block_response(serialInput) # ACK or NAK from the '#block' loader
+         serialInput = serialInput.decode('utf-8','replace')
+         if "\ufffd" in serialInput: # Corrupt characters, e.g. a speed mismatch or a noisy link
+            self.rxErrors += serialInput.count("\ufffd")
+         if self.baudHistory and serialInput: # Only a speed negotiated by '#baud' falls back
+            self.rx_error_rate(serialInput)
          serialInput = self.strip_nonprinting(serialInput)
 
          # Send what ever is received to the terminal unless dislayOutput is False
          if self.displayOutput == True:
-            sys.stdout.write(serialInput)
-            sys.stdout.flush()
+            self.terminal.write(serialInput)
+         if serialInput: # The log gets everything, even if the terminal drops it
+            with self.logLock: # '#log' may change or close it from the keyboard thread
+               if self.sessionLog:
+                  self.sessionLog.write(serialInput)
 
          recvBuffer = recvBuffer + serialInput # Fill the receive buffer with everything received
          # Split the receive buffer into complete lines and store in lastLines list
          while "\n" in recvBuffer:
+            line = recvBuffer.partition('\n')[0]
+            if self.error_response(line): # Flag compile errors so uploads can stop immediately
+               self.errorLine = line
+               self.definitionOpen = False # An error ends compilation
             self.newlineCount += 1  # Increment newline counter which is cleared by other methods esp. waitNewline()
-            self.lastLines.append(recvBuffer.partition('\n')[0]) # Add the last full line to the list
+            self.linesReceived += 1
+            self.lastLines.append(line) # Add the last full line to the list
             recvBuffer = recvBuffer.partition('\n')[2] # Save any additional characters to an empty buffer
             # Delete lastLines more than max (default = 10)
             while len(self.lastLines) > self.maxLastLines:
                del self.lastLines[0] # Delete oldest line
 
+      self.serial_port.close() # Also closes any trace being recorded
+      with self.logLock:
+         if self.sessionLog:
+            self.sessionLog.close()
+      self.terminal.stop()
       print("Receive thread stopped!")
 
    def serial_receive(self):
@@ -124,12 +492,78 @@ class ForthTalk():
 
    def waitNewline(self,nlRecvd,timeout):
       ''' Block thread until required number of NL's received or timeout expires '''
+      start = monotonic()
       self.newlineCount = 0  # Incremented by _serial_receive
       nlTimeout = 0.0
       while self.newlineCount < nlRecvd and nlTimeout < timeout:
          sleep(0.05)
          nlTimeout = nlTimeout + 0.05 # 50 mS granularity
       # print("NLs:",self.newlineCount,"nlTimeout:",nlTimeout) # Debug line
+      self.serial_wait(start)
+
+   def waitIdle(self,idle,timeout):
+      ''' Block thread until nothing has been received for 'idle' seconds and the Forth system
+         isn't holding off sending with XOFF, or timeout expires. Used with 'xon' flow control
+         where lines are sent without waiting for each response.
+      '''
+      start = monotonic()
+      deadline = start + timeout
+      while monotonic() < deadline:
+         if self.xon.is_set() and monotonic() - self.lastReceived >= idle:
+            break
+         sleep(0.05)
+      self.serial_wait(start)
+
+   def serial_wait(self,start):
+      ''' Add the time since 'start' to the time this thread has spent waiting on the serial
+         port. Used by '#profile' to split time between host CPU and the Forth system.
+      '''
+      self.waitTimes[threading.get_ident()] += monotonic() - start
+
+   def flow_control(self,data):
+      ''' Update the XON/XOFF state from the last XON (CTRL-Q) or XOFF (CTRL-S) in the data
+         received and return the data with these control characters removed.
+      '''
+      if data.rfind(b"\x13") > data.rfind(b"\x11"):
+         self.xon.clear()
+      else:
+         self.xon.set()
+      return data.replace(b"\x11",b"").replace(b"\x13",b"")
+
+   def block_response(self,data):
+      ''' Take the loader's replies, ACK (CTRL-F) or NAK (CTRL-U) followed by the next
+         sequence number it expects, out of the data received and put them on 'blockReplies'.
+         Returns the rest of the data.
+      '''
+      data = self.blockPending + data
+      self.blockPending = b""
+      rest = bytearray()
+      i = 0
+      while i < len(data):
+         if data[i] in (0x06,0x15):
+            if i + 1 == len(data): # Sequence number still to come
+               self.blockPending = data[i:]
+               break
+            self.blockReplies.put((data[i] == 0x06,(data[i+1] - 0x30) % 64))
+            i += 2
+         else:
+            rest.append(data[i])
+            i += 1
+      return bytes(rest)
+
+   def rx_error_rate(self,text):
+      ''' Keep the characters and corrupt characters received over the last 'rxErrorWindow'
+         seconds, and fall back to a slower speed if the error rate is too high. A few
+         glitches spread over hours don't add up to a fallback.
+      '''
+      now = monotonic()
+      self.rxHistory.append((now,len(text),text.count("\ufffd")))
+      while self.rxHistory[0][0] < now - self.rxErrorWindow:
+         self.rxHistory.popleft()
+      received = sum(entry[1] for entry in self.rxHistory)
+      errors = sum(entry[2] for entry in self.rxHistory)
+      if errors >= self.maxRxErrors and errors >= self.maxRxErrorRate * received:
+         self.baudFallback = True
 
    def strip_nonprinting(self,text):
       ''' Strip non-printable characters apart from NL and CR '''
@@ -139,11 +573,55 @@ class ForthTalk():
             printable = printable + c
       return printable
 
+   def query(self,text,timeout=0.5):
+      ''' Send a line to the Forth system with the terminal display turned off and return
+         the reply, i.e. the rest of the received line echoing 'text', without the 'ok' prompt.
+         Returns None if no reply is received within 'timeout' seconds.
+      '''
+      displayOutput = self.displayOutput  # Save current state of displayOutput
+      self.displayOutput = False
+      linesReceived = self.linesReceived
+      self.send_data(text)
+      deadline = monotonic() + timeout
+      reply = self._reply(text,linesReceived)
+      while reply == None and monotonic() < deadline:
+         self.waitNewline(1,deadline - monotonic())
+         reply = self._reply(text,linesReceived)
+      self.displayOutput = displayOutput # Restore displayOutput state
+      return reply
+
+   def _reply(self,text,linesReceived):
+      ''' Look for the reply to 'text' in the lines received since 'linesReceived' '''
+      newLines = min(self.linesReceived - linesReceived, len(self.lastLines))
+      for line in self.lastLines[len(self.lastLines)-newLines:]:
+         if text in line:
+            reply = line.partition(text)[2]
+            return reply.rpartition(" ok")[0] if " ok" in reply else reply.strip()
+      return None
+
+   def query_number(self,text):
+      ''' Send 'text' which leaves a number on the stack and return the number, or None. The
+         number is printed in hex and 'base' restored afterwards.
+      '''
+      reply = self.query(text + " base @ swap hex u. base !")
+      try:
+         return int(reply.split()[0],16)
+      except (AttributeError,IndexError,ValueError):
+         return None
+
+   def error_response(self,line):
+      ''' flashforth reports an error by printing the offending word followed by '?',
+         e.g. 'foo ?'. A successful line always ends with the ' ok<#,ram>' prompt instead.
+      '''
+      line = line.rstrip()
+      return line == "?" or line.endswith(" ?")
+
    def output(self,*args):
-      ''' Print messages controlled by the state of 'displayOutput' '''
+      ''' Print messages controlled by the state of 'displayOutput'. These go through the terminal
+         output thread so they stay in order with the data received.
+      '''
       if self.displayOutput:
-         for arg in args:
-            print(arg,end="")
+         self.terminal.write("".join(str(arg) for arg in args))
 
 # ========================== Command Handler ========================
 
@@ -153,6 +631,10 @@ class ForthTalk():
          the command word. Synonyms or short versions can also be added if required.
       '''
 
+      if self.profiling and not self.profileActive:
+         self.profile_command(text)
+         return
+
       commandList = {
          "#send":self.send_file, # Uploads a file to the Forth system
          "#include":self.send_file, # Same as #send
@@ -160,6 +642,7 @@ class ForthTalk():
          "#comp":self.compile_file, # Compiles a list of required files and sends them to the Forth system
          "#file":self.analyse_file, # Analyses a file for words that need other files to be uploaded
          "#defs":self.find_definitions, # Searches the pathList for files that have definitions
+         "#watch":self.watch, # Watches the pathList for changed files and uploads them again
          "#lits":self.add_lits, # Add literal definitions to MCUREGS. Format: litName:litDef e.g. SPI_MOSI:$3
          "#path":self.add_path, # Adds a path to the pathList
          "#warm":self.warm_start, # Initiates a warm start. Same as sending 'warm' directly to the Forth system
@@ -167,21 +650,40 @@ class ForthTalk():
          '#list':self.list_words, # Shorthand for '#words list'
          "#words":self.defined_words, # Default is to send 'words' to the Forth system and save these in definedWords
          "#find":self.find_words, # Find a word or words in the definedWords list
-         "#hex":self.hex_convert, # Search a file for hex literals prefix by $ and convert to lower case if necessary
+         "#hex":self.hex_convert, # Search files, directories or globs for hex literals prefix by $ and convert to lower case if necessary
+         "#port":self.set_port, # Print or change the serial port
+         "#speed":self.set_speed, # Print or change the serial port speed (host only)
+         "#baud":self.baud, # Negotiates a faster speed with the Forth system
+         "#log":self.log, # Logs everything received to a file, '#log off' stops
+         "#record":self.record, # Records all data sent and received to a trace file, '#record off' stops
+         "#flow":self.flow, # Sets flow control: 'newline' (wait for NL after each line) or 'xon'
          "#last":self.last_lines, # Copies of last lines received from the Forth system
-         "#stats":self.memory_stats # Prints out free memory statistics after interrogating the Forth system
+         "#onerror":self.on_error, # Action on a compile error during upload: stop, rollback or continue
+         "#stats":self.memory_stats, # Prints out free memory statistics after interrogating the Forth system
+         "#profile":self.profile, # Profiles commands, splitting time between host CPU and serial waits
+         "#snapshot":self.snapshot, # Saves the user flash dictionary to a file e.g. #snapshot build.json
+         "#restore":self.restore, # Writes a '#snapshot' file back to the Forth system
+         "#block":self.block_upload, # Uploads a file in checked blocks through a loader on the Forth system
+         "#time":self.time_word, # Times a word on the Forth system using a timer register e.g. #time myword 100
+         "#telemetry":self.telemetry_command, # Samples free memory in the background while the link is idle
+         "#footprint":self.footprint_command # Profiles the memory used by each file or definition uploaded
          }
 
       if len(text.split(" ",1)) > 1 :       # Check for argument(s)
          self.command_args = text.split(" ",1)[1] # Command argument(s)
       command = text.split(" ",1)[0] # Command
+      self.terminal.flush() # Commands use print, so display everything received first
       try:
          execute_command = commandList[command]
          errorMessage = execute_command()  # Some commands return an error message
          if errorMessage:
             print("Error executing command:",command," - ",errorMessage)
+            self.errors += 1
+            self.progress("error",command=command,message=errorMessage)
       except KeyError as e:
          print("\nCommand not recognised:",command,"\n")
+         self.errors += 1
+         self.progress("error",command=command,message="Command not recognised")
       self.command_args = "" # Clear the command argument
       self.send_data("") # Get a new prompt - send_data sends "\n"
 
@@ -205,6 +707,8 @@ class ForthTalk():
          self.analyse_file(pathfile)
          for file in reversed(self.compileFiles):
             self.run_command("#send " + file)
+            if self.uploadAborted: # Don't send the remaining files after a compile error
+               break
       else:
          return ("File not found: " + self.command_args)
 
@@ -215,7 +719,8 @@ class ForthTalk():
          If not, add '.frt' as the standard Forth file extension.
          Look to see if the filename is specified with a full pathname or if it's in 
          the current working directory.
-         If not, search the pathList and return the fullpath to the first file match.
+         If not, search the pathList and return the fullpath to the first file match,
+         then the files found below the pathList by '#defs'.
          If the file is not found, return False.
       '''
       if filename == None: # If no filename provided
@@ -240,6 +745,8 @@ class ForthTalk():
                   pathfile = False
          else:
             pathfile = False
+         if not pathfile and filename in self.fileIndex: # Found in a sub-directory by '#defs'
+            pathfile = self.fileIndex[filename]
          return pathfile
 
    def analyse_file(self,pathfile=None):
@@ -338,23 +845,58 @@ class ForthTalk():
       return wordsNotFound
 
    def find_definitions(self):
-      ''' Search the directories in self.paths for word definitions storing the words
-         and file paths in self.wordFiles
+      ''' Search the directories in self.paths, and the directories below them, for word
+         definitions storing the words and file paths in self.wordFiles
       '''
-      for path in self.pathList:
-         for name in os.listdir(path):
-            pathfile = os.path.join(path,name)
-            if os.path.isfile(pathfile) and name[-4:] == ".frt":
-               self._find_definitions(pathfile)
+      for pathfile,mtime in self.source_files().items():
+         self._find_definitions(pathfile)
+         self.fileTimes[pathfile] = mtime
       self.output("Words defined in files:")
       if self.displayOutput:
          for word in self.wordFiles:
             print(word,end=" ")
 
+   def source_files(self):
+      ''' Returns the modification time of every '.frt' file in or below the pathList,
+         by full path. os.scandir gets the file type without a separate call for each file.
+      '''
+      files = {}
+      visited = set() # Real paths of directories scanned, so symlink loops are only followed once
+      directories = list(reversed(self.pathList))
+      while directories:
+         directory = directories.pop()
+         try:
+            realPath = os.path.realpath(directory)
+            if realPath in visited:
+               continue
+            visited.add(realPath)
+            entries = sorted(os.scandir(directory),key=lambda entry:entry.name)
+         except OSError:
+            continue
+         for entry in reversed(entries):
+            try:
+               if entry.is_dir():
+                  directories.append(entry.path)
+               elif entry.name[-4:] == ".frt" and entry.is_file():
+                  files.setdefault(entry.path,entry.stat().st_mtime) # First in the pathList wins
+            except OSError: # e.g. a broken symlink
+               continue
+      return files
+
    def _find_definitions(self,filename):
-      ''' Processes a file to find any words defined within the file'''
+      ''' Processes a file to find any words defined within the file. Words previously found
+         in the file are forgotten first, so a changed file can be processed again.
+      '''
 
       if filename:
+         name = os.path.basename(filename)
+         for word in self.fileWords.get(name,()):
+            if self.wordFiles.get(word) == name:
+               del self.wordFiles[word]
+         self.unindex_words(self.fileWords.get(name,()))
+         self.fileIndex.setdefault(name,filename)
+         self.fileWords[name] = set()
+         self.fileUses[name] = set()
          try:
             with open(filename, 'rb') as f:
                while True:
@@ -366,15 +908,84 @@ class ForthTalk():
                      continue
                   if current_line.strip_comments(): # Returns False if line is empty
                         splitLine = current_line.text.split()
+                        self.fileUses[name].update(splitLine)
                         for i in range(len(splitLine)):
                            if splitLine[i] == ':' :  # Line contains a definition
                               if splitLine[i+1]:     # Check there is a word after the colon
                                  # If so, add the word and the filename to the dictionary: wordFiles
-                                 self.wordFiles[splitLine[i+1]] = os.path.basename(filename)
+                                 self.wordFiles[splitLine[i+1]] = name
+                                 self.wordIndex.add(splitLine[i+1])
+                                 self.fileWords[name].add(splitLine[i+1])
                               else:
                                  print("No word after defining word!!!")
          except IOError as e:
             sys.stderr.write('--- ERROR opening file {}: {} ---\n'.format(filename, e))
+         self.fileUses[name] -= self.fileWords[name]
+
+   def watch(self):
+      ''' Watch the files in and below the pathList for changes. When a file is saved its
+         definitions are found again and, if it has been uploaded, it is uploaded again
+         followed by any uploaded files which use words it defines (and files which use
+         theirs), in the order they were originally uploaded.
+         Arguments:
+            No args: Print whether watching
+            on     : Start watching
+            off    : Stop watching
+            secs   : Set the time between checks (default: 1.0)
+      '''
+      if self.command_args == "":
+         print("Watch:","on" if self.watchStop else "off","every",self.watchInterval,"seconds")
+      elif self.command_args == "on":
+         if not self.watchStop:
+            if not self.fileTimes: # Index the files to compare against
+               displayOutput = self.displayOutput
+               self.displayOutput = False
+               self.find_definitions()
+               self.displayOutput = displayOutput
+            self.watchStop = threading.Event()
+            threading.Thread(target=self._watch,args=(self.watchStop,)).start()
+      elif self.command_args == "off":
+         if self.watchStop:
+            self.watchStop.set()
+            self.watchStop = None
+      else:
+         try:
+            self.watchInterval = float(self.command_args)
+         except ValueError:
+            return ("Unknown watch argument: " + self.command_args)
+
+   def _watch(self,stop):
+      ''' Watch thread. Compares file modification times every 'watchInterval' seconds '''
+      while not stop.wait(self.watchInterval) and not self.exit:
+         files = self.source_files()
+         changed = [pathfile for pathfile in files if self.fileTimes.get(pathfile) != files[pathfile]]
+         for pathfile in self.fileTimes.keys() - files.keys(): # Deleted files
+            del self.fileTimes[pathfile]
+         if not changed:
+            continue
+         with self.sendLock: # Commands from the keyboard thread read the word and file indexes
+            for pathfile in changed:
+               self.fileTimes[pathfile] = files[pathfile]
+               self._find_definitions(pathfile)
+            uploads = self.dependants([os.path.basename(pathfile) for pathfile in changed])
+            for name in uploads:
+               self.output(' ===> Reloading: ',name,"\n")
+               self.file_upload(self.fileIndex.get(name) or self.find_file(name))
+               if self.uploadAborted:
+                  break
+            self.send_data("") # Get a new prompt
+
+   def dependants(self,names):
+      ''' Returns the uploaded files in 'names' and those which use words defined in them,
+         directly or indirectly, in the order they were uploaded
+      '''
+      affected = set(names)
+      words = set().union(*(self.fileWords.get(name,set()) for name in names))
+      while words:
+         newFiles = [name for name in self.fileUses if name not in affected and self.fileUses[name] & words]
+         affected.update(newFiles)
+         words = set().union(*(self.fileWords[name] for name in newFiles))
+      return [name for name in self.uploadOrder if name in affected]
 
    def add_lits(self):
       if self.command_args == "":
@@ -390,6 +1001,7 @@ class ForthTalk():
             if litName in MCUREGS and litValue != MCUREGS[litName]:
                print("Literal",litName,"value",MCUREGS[litName],"overwritten with:",litValue)
             MCUREGS[litName] = litValue
+            self.wordIndex.add(litName)
 
    def add_path(self):
       if self.command_args == "" and self.displayOutput :  # No arguments and displayOuput = True
@@ -401,12 +1013,228 @@ class ForthTalk():
    def warm_start(self):
       print("Warm start...")
       self.send_data('\017')          # flashforth warm start = CTRL-O
+      self.loaderInstalled = False # Check for the '#block' loader again
+      if self.baudHistory: # The Forth system restarts at its base speed
+         self.baudHistory = []
+         self.serial_port.baudrate = self.baseSpeed
+
+   def set_port(self):
+      ''' Print the serial port or close it and open another one. Ignored in the config
+         file as the port has already been opened by then.
+      '''
+      if self.command_args == "":
+         print("Port:",self.portName,"Speed:",self.serial_port.baudrate)
+      elif not self.startup and self.command_args != self.portName:
+         serial_port = open_port(self.command_args,self.serial_port.baudrate)
+         if not serial_port:
+            return ("Could not open port: " + self.command_args)
+         self.serial_port.close()
+         self.serial_port = serial_port
+         self.portName = self.command_args
+         self.baudHistory = []
+         if self.flowControl != "xon": # Pipeline lines over a network, wait for each line locally
+            self.flowControl = "window" if is_url(self.portName) else "newline"
+            self.windowBase = self.linesReceived - self.linesSent
+
+   def log(self):
+      ''' Start or stop logging everything received from the Forth system to a file. The log
+         is complete even when the terminal can't keep up and output is dropped.
+         Arguments:
+            No args : Print the log file, if any
+            filename: Start logging to the file (appends)
+            off     : Stop logging
+      '''
+      sessionLog = self.sessionLog
+      if self.command_args == "":
+         print("Log:",sessionLog.name if sessionLog else "off")
+         return
+      newLog = None
+      if self.command_args != "off":
+         try:
+            newLog = open(self.command_args,'a')
+         except IOError as e:
+            return ("Could not open log file: " + str(e))
+      with self.logLock: # The receive thread may be writing to the old log
+         sessionLog,self.sessionLog = self.sessionLog,newLog
+         if sessionLog:
+            sessionLog.close()
+
+   def record(self):
+      ''' Start or stop recording a trace of all data sent and received. A trace can be replayed
+         in place of the Forth system with the '--replay' command line option.
+         Arguments:
+            No args : Print the trace file being recorded, if any
+            filename: Start recording to the file
+            off     : Stop recording
+      '''
+      recording = isinstance(self.serial_port,TraceRecorder)
+      if self.command_args == "":
+         print("Recording:",self.serial_port.filename if recording else "off")
+      elif self.command_args == "off":
+         if recording:
+            self.serial_port = self.serial_port.stop()
+      else:
+         if recording:
+            self.serial_port = self.serial_port.stop()
+         try:
+            self.serial_port = TraceRecorder(self.serial_port,self.command_args)
+         except IOError as e:
+            return ("Could not open trace file: " + str(e))
+
+   def flow(self):
+      ''' Print or set the flow control used when sending to the Forth system.
+         Arguments:
+            No args : Print the current setting
+            newline : Wait for a NL (or timeout) after sending each line (default for local ports)
+            xon     : Stream lines without waiting, pausing whenever the Forth system sends
+                      XOFF until it sends XON. flashforth uses XON/XOFF while writing to flash.
+            window n: Send up to n lines (default 4) before waiting for responses (default for
+                      network ports e.g. socket://host:port)
+      '''
+      args = self.command_args.split()
+      if not args:
+         print("Flow control:",self.flowControl,"Window:",self.sendWindow)
+      elif args[0] in ("newline","xon","window"):
+         if len(args) > 1:
+            if not args[1].isdigit() or int(args[1]) < 1:
+               return ("Invalid window size: " + args[1])
+            self.sendWindow = int(args[1])
+         self.flowControl = args[0]
+         self.windowBase = self.linesReceived - self.linesSent
+         self.xon.set()
+      else:
+         return ("Unknown flow control: " + self.command_args)
+
+   def set_speed(self):
+      ''' Print the serial port speed or change the speed used by forthtalk. This doesn't
+         change the speed of the Forth system - use '#baud' for that. Ignored in the config
+         file as the port has already been opened by then.
+      '''
+      if self.command_args == "":
+         print("Speed:",self.serial_port.baudrate)
+      elif not self.startup:
+         try:
+            self.serial_port.baudrate = int(self.command_args)
+         except ValueError:
+            return ("Invalid speed: " + self.command_args)
+
+   def baud(self):
+      ''' Change the speed of the serial link. The Forth system's UART baud rate register is
+         written, forthtalk changes to the same speed and the link is checked with echo tests.
+         If the tests fail the previous speed is restored.
+         Arguments:
+            No args   : Try each speed in 'self.baudRates' faster than the current speed,
+                        stopping at the first one that fails
+            speed(s)  : Try the given speed(s) in order, e.g. #baud 115200
+            base      : Return to the speed the Forth system started at
+            clock Hz  : Set the Forth system CPU clock used to calculate the baud rate divisor
+      '''
+      args = self.command_args.split()
+      if args[:1] == ["clock"]:
+         if len(args) < 2 or not args[1].isdigit():
+            return ("Clock frequency required e.g. #baud clock 16000000")
+         self.cpuClock = int(args[1])
+         return
+      if self.portName.startswith("socket://"): # Raw TCP, the server's serial speed can't be changed
+         return ("Speed can't be changed over socket://, set it on the serial server")
+      if args[:1] == ["base"]:
+         if self.baudHistory and not self.switch_baud(self.baseSpeed):
+            return ("Link lost: reset the Forth system")
+         self.baudHistory = []
+         return
+      try:
+         speeds = [int(arg) for arg in args]
+      except ValueError:
+         return ("Invalid speed: " + self.command_args)
+      if not speeds:
+         speeds = [speed for speed in self.baudRates if speed > self.serial_port.baudrate]
+
+      divisor = self.uart_divisor()
+      for speed in speeds:
+         ubrr = round(self.cpuClock / (divisor * speed)) - 1
+         actual = self.cpuClock / (divisor * (ubrr + 1)) if ubrr >= 0 else 0
+         if ubrr < 0 or ubrr > 4095 or abs(actual - speed) / speed > self.maxBaudError:
+            print("Speed",speed,"not possible with a",self.cpuClock,"Hz clock")
+            continue
+         previous = self.serial_port.baudrate
+         print("Trying",speed,"baud... ",end="")
+         if self.switch_baud(speed,divisor):
+            print("OK")
+            self.baudHistory.append(speed)
+         else:
+            print("failed")
+            if not self.switch_baud(previous,divisor):
+               self.baudHistory.append(speed) # Keep the history in step for baud_fall_back
+               self.baud_fall_back()
+            break
+      print("Speed:",self.serial_port.baudrate)
+
+   def uart_divisor(self):
+      ''' The baud rate divisor is 8 if the Forth system's UART is in double speed mode (U2X0)
+         or 16 otherwise.
+      '''
+      current_line = LineProcessor("UCSR0A c@ UCSR0A_U2X0 and u.")
+      current_line.substitute_registers()
+      self.uartDivisor = 8 if self.query(current_line.text) == "2" else 16
+      return self.uartDivisor
+
+   def switch_baud(self,speed,divisor=16):
+      ''' Write the baud rate register on the Forth system, switch forthtalk to the same
+         speed and run echo tests over the link. Returns True if all the tests pass.
+      '''
+      ubrr = max(round(self.cpuClock / (divisor * speed)) - 1, 0)
+      register = int(MCUREGS["UBRR0"][1:],16)
+      # UBRR0H must be written before UBRR0L. Use '#' decimal literals so 'base' doesn't matter
+      line = "#{} ${:x} c! #{} ${:x} c!".format(ubrr >> 8, register + 1, ubrr & 0xff, register)
+      displayOutput = self.displayOutput  # Save current state of displayOutput
+      self.displayOutput = False
+      self.serial_port.write((line + "\n").encode('utf-8'))
+      self.serial_port.flush()
+      # The echo comes back at the old speed, then the Forth system switches
+      sleep(12.0 * (len(line) + 2) / self.serial_port.baudrate + 0.05)
+      self.serial_port.baudrate = speed
+      sleep(0.05)
+      self.serial_port.reset_input_buffer()
+      self.rxErrors = 0
+      self.rxHistory.clear()
+      self.baudFallback = False
+      linkOK = self.link_test()
+      self.displayOutput = displayOutput # Restore displayOutput state
+      return linkOK
+
+   def link_test(self):
+      ''' Send comment lines with a test pattern and check they are echoed back correctly.
+         Returns True if all 'self.linkTests' echoes are received without errors.
+      '''
+      self.send_data("") # Get a clean prompt
+      for i in range(self.linkTests):
+         text = "\\ ftk " + "".join(chr(ord("0") + (i * 7 + n) % 75) for n in range(32))
+         if self.query(text) == None:
+            return False
+      return self.rxErrors == 0
+
+   def baud_fall_back(self):
+      ''' Called before sending when the receive thread has seen too many corrupt characters.
+         Step back through the speeds negotiated by '#baud' until the link works again.
+      '''
+      self.baudFallback = False
+      while self.baudHistory:
+         self.baudHistory.pop()
+         speed = self.baudHistory[-1] if self.baudHistory else self.baseSpeed
+         sys.stderr.write('--- Link errors, falling back to {} baud ---\n'.format(speed))
+         if self.switch_baud(speed,self.uartDivisor):
+            return
+      sys.stderr.write('--- Link lost: reset the Forth system ---\n')
 
    def empty(self):
       print("Defined words back to 'marker' removed")
       self.send_data('empty')
+      self.loaderInstalled = False # Check for the '#block' loader again
+      self.dictionaryStart = self.query_number("flash here ram") # Default start for '#snapshot'
       endUser = self.definedWords.index("marker") # Find index for marker
+      removed = self.definedWords[:endUser]
       self.definedWords = self.definedWords[endUser:]
+      self.unindex_words(removed) # Words still in definedWords are kept, so update it first
 
    def list_words(self):
       self.command_args = "list"
@@ -426,6 +1254,7 @@ class ForthTalk():
          # Get words from the Forth system. Use 'self.output' rather than 'print'
          displayOutput = self.displayOutput  # Save current state of DisplayOutput
          self.displayOutput = False # Turn off terminal display
+         oldWords = self.definedWords
          self.send_data("words\n")
          self.waitNewline(3,3.0) # 3 x NL or 3.0 seconds
          self.displayOutput = displayOutput # Restore displayOutput state
@@ -436,6 +1265,9 @@ class ForthTalk():
             self.definedWords = (lastLine[0] + lastLine[1]).split() # User defined words
             self.output("Words received... ",len(self.definedWords)-1, " user defined words")
             self.definedWords.extend(self.lastLines[-3].split()) # All words
+            for word in self.definedWords:
+               self.wordIndex.add(word)
+            self.unindex_words(set(oldWords) - set(self.definedWords))
          else:
             print("\n**** Words not received!!! ***")
       # Other arguments
@@ -448,41 +1280,93 @@ class ForthTalk():
          print("\nDefined words (alphabetical):",sorted(self.definedWords))
 
    def find_words(self):
+      ''' Find words in the definedWords list. A word ending in '*' is a prefix: all words
+         starting with it are listed from definedWords, the files searched by '#defs' and
+         the register names and literals in MCUREGS.
+      '''
       words = self.command_args.split()
       if len(words) == 0:
          print("!!!   No words to find   !!!")
          return
       for word in words:
-         if word in self.definedWords:
+         if word.endswith("*") and len(word) > 1:
+            matches = self.wordIndex.find(word[:-1])
+            print("Found ",len(matches)," words starting '",word[:-1],"':",sep="")
+            for match in matches:
+               where = "defined" if match in self.definedWords else self.wordFiles.get(match) or "literal " + MCUREGS.get(match,"")
+               print("   ",match,"(" + where + ")")
+         elif word in self.definedWords:
             print("Found: '",word,"'",sep="")
          else:
             print("Not found:'",word,"'",sep="")
 
+   def unindex_words(self,words):
+      ''' Remove words from the word index unless they are still known from elsewhere '''
+      for word in words:
+         if word not in self.wordFiles and word not in MCUREGS and word not in self.definedWords:
+            self.wordIndex.remove(word)
+
    def hex_convert(self):
-      ''' Searches a file for hex literals in upper case. Prefixes literal with
-         '$' and converts to lower case if necessary. '''
-      pathfile = self.find_file()
-      if not pathfile:
+      ''' Searches files for hex literals in upper case. Prefixes literal with
+         '$' and converts to lower case if necessary. Arguments can be files, directories
+         (all '.frt' files below the directory) or glob patterns (the '.frt' files matched)
+         e.g. #hex lib/**/*.frt
+         Files are converted in parallel by separate processes (see 'hex_convert_file').
+         Each is written to a temporary file which then replaces the original, so a crash
+         can't lose a file. Files found to have nothing to convert are remembered by their
+         hash and skipped next time.
+      '''
+      files = self.hex_files(self.command_args) # A single file name may contain spaces
+      if not files:
+         for arg in self.command_args.split():
+            files.extend(self.hex_files(arg))
+      if not files:
          return ("File not found: " + self.command_args)
+      files = list(dict.fromkeys(files)) # A file may be matched by more than one argument
 
-      try:
-         with open(pathfile, 'rb+') as f:
+      cleanDigests = [self.hexClean.get(pathfile) for pathfile in files]
+      if len(files) == 1: # Not worth starting processes for
+         results = [hex_convert_file(files[0],cleanDigests[0])]
+      else:
+         try:
+            with concurrent.futures.ProcessPoolExecutor(min(self.hexWorkers,len(files))) as pool:
+               results = list(pool.map(hex_convert_file,files,cleanDigests))
+         except OSError: # Processes not available, e.g. no shared memory for the pool
+            results = list(map(hex_convert_file,files,cleanDigests))
+      converted = 0
+      for pathfile,(changed,digest,error) in zip(files,results):
+         if error:
+            sys.stderr.write('--- ERROR converting file {}: {} ---\n'.format(pathfile, error))
+            continue
+         if changed:
+            converted += 1
             self.output(' ===> Hex conversion on file: ',pathfile, "\n")
-            lines = f.readlines()
-            f.seek(0)
-            f.truncate()
-            converted_file = ""
-            for line in lines:
-               current_line = LineProcessor(line.decode('utf-8'))
-               current_line.hex_convert()
-               converted_file = converted_file + current_line.text + "\n"
-            f.write(converted_file.encode('utf-8'))
-
-         self.output(' ===> Finished hex conversion on file: ',pathfile,"\n")
-
-      except IOError as e:
-         sys.stderr.write('--- ERROR opening file {}: {} ---\n'.format(pathfile, e))
-
+         self.hexClean[pathfile] = digest
+      self.output(' ===> Hex conversion finished: ',converted,' of ',len(files),' files converted',"\n")
+
+   def hex_files(self,arg):
+      ''' Returns a list of files for '#hex' from a file name, directory or glob pattern '''
+      if glob.has_magic(arg):
+         return [pathfile for pathfile in glob.glob(arg,recursive=True) if os.path.isfile(pathfile) and pathfile[-4:] == ".frt"]
+      if os.path.isdir(arg):
+         return [os.path.join(path,name) for path,dirs,names in os.walk(arg) for name in sorted(names) if name[-4:] == ".frt"]
+      pathfile = self.find_file(arg)
+      return [pathfile] if pathfile and os.path.isfile(pathfile) else []
+
+   def on_error(self):
+      ''' Set the action taken when the Forth system reports an error during a file upload.
+         Arguments:
+            No args : Print the current setting
+            stop    : Stop the upload and report the file, line number and source line (default)
+            rollback: As 'stop', then execute the last 'marker' word sent to remove the partial upload
+            continue: Keep sending the rest of the file (original behaviour)
+      '''
+      if self.command_args == "":
+         print("On error:",self.onError)
+      elif self.command_args in ("stop","rollback","continue"):
+         self.onError = self.command_args
+      else:
+         return ("Unknown error action: " + self.command_args)
 
    def clear_last(self):
       ''' Clear the lastLines buffer and reset the newlineCount
@@ -501,45 +1385,856 @@ class ForthTalk():
          print(numLines-i,": ",self.lastLines[numLines-1-i])
 
    def memory_stats(self):
-      self.displayOutput = False
-      self._stats("flash")
-      self._stats("eeprom")
-      self._stats("ram")
-      self.waitNewline(2,0.3)  # Wait 2 x NL or 0.3 seconds
-      self.displayOutput = True # Turn on terminal display
-      # Pick up data from lastLines buffer. Line format: "flash hi here - u. 1535"
+      ''' Prints out free memory statistics after interrogating the Forth system '''
+      stats = self.memory_snapshot()
       print("Memory stats:")
-      for i in range(-2, -8, -2):
-         lineSplit = self.lastLines[i].split()
-         print("Free",lineSplit[0],": ",lineSplit[5],"bytes")
-      print(self.lastLines[-1]) # Print the last line received (prompt)
+      for memory in ("flash","eeprom","ram"):
+         print("Free",memory,": ",stats[memory] if stats[memory] != None else "?","bytes")
+
+   def memory_snapshot(self):
+      ''' Returns a dictionary of free bytes for 'flash', 'eeprom' and 'ram' (None if unknown) '''
+      return {memory:self._stats(memory) for memory in ("flash","eeprom","ram")}
 
    def _stats(self,memory):
-      self.send_data(memory + " hi here - u. \n")
+      ''' Returns the free bytes in 'memory' or None if there is no valid reply. The value is
+         printed in decimal and 'base' restored afterwards.
+      '''
+      reply = self.query(memory + " hi here - base @ swap decimal u. base !")
+      try:
+         return int(reply.split()[0])
+      except (AttributeError,IndexError,ValueError):
+         return None
+
+   def profile(self):
+      ''' Profile commands (and the uploads they run) with cProfile.
+         Arguments:
+            No args  : Print the wall time, host CPU time and serial wait of each profiled command
+            on       : Profile each command from now on
+            off      : Stop profiling
+            dump [dir]: Save a pstats file for each profiled command in dir (default: profile)
+                       e.g. profile/1-comp.pstats. View with: python3 -m pstats file, snakeviz
+                       or convert for flame graphs with flameprof
+            clear    : Delete the profiles
+      '''
+      args = self.command_args.split()
+      if not args:
+         print("Profiling:","on" if self.profiling else "off")
+         for i,(text,wall,cpu,wait,stats) in enumerate(self.profiles,1):
+            print("{:>3}: wall {:8.3f}s  host CPU {:8.3f}s  serial wait {:8.3f}s  {}".format(i,wall,cpu,wait,text))
+      elif args[0] == "on":
+         self.profiling = True
+      elif args[0] == "off":
+         self.profiling = False
+      elif args[0] == "clear":
+         self.profiles = []
+      elif args[0] == "dump":
+         directory = args[1] if len(args) > 1 else "profile"
+         try:
+            os.makedirs(directory,exist_ok=True)
+            for i,(text,wall,cpu,wait,stats) in enumerate(self.profiles,1):
+               name = "".join(c for c in text.split()[0] if c.isalnum())
+               stats.dump_stats(os.path.join(directory,"{}-{}.pstats".format(i,name)))
+         except (IOError,OSError) as e:
+            return ("Could not save profiles: " + str(e))
+         print(len(self.profiles),"profiles saved in",directory)
+      else:
+         return ("Unknown profile argument: " + self.command_args)
+
+   def snapshot(self):
+      ''' Save the user flash dictionary to a JSON file with the dictionary pointers for flash,
+         eeprom and ram, 'latest' and a CRC-32, for '#restore'. A small reader word is defined
+         above the dictionary (and removed afterwards) to read memory back in hex.
+         Format: #snapshot file [start]
+            start: Start address of the user dictionary in hex e.g. $0700. The default is the
+                   flash 'here' after the last '#empty'.
+         EEPROM and RAM contents are not saved, only their dictionary pointers. Assumes
+         FlashForth: 'latest', and 'allot' accepting a negative count to move 'here' back.
+      '''
+      args = self.command_args.split()
+      if not args:
+         return ("Snapshot file name required")
+      start = self.dictionaryStart
+      if len(args) > 1:
+         try:
+            start = int(args[1].lstrip("$"),16)
+         except ValueError:
+            return ("Invalid start address: " + args[1])
+      if start == None:
+         return ("Dictionary start unknown: give a start address or use #empty first")
+
+      pointers = self.dictionary_pointers()
+      if None in pointers.values():
+         return ("Could not read dictionary pointers")
+      if pointers["flash"] < start:
+         return ("Start address is above flash here: ${:x}".format(pointers["flash"]))
+      data = self.read_memory(start,pointers["flash"] - start)
+      if data == None:
+         return ("Memory read failed")
+
+      snapshot = {"format":"forthtalk snapshot","version":1,"start":start,"here":pointers,
+                  "crc32":zlib.crc32(data),"data":data.hex()}
+      try:
+         with open(args[0],'w') as f:
+            json.dump(snapshot,f)
+      except IOError as e:
+         return ("Could not write snapshot file: " + str(e))
+      print("Snapshot saved:",args[0],len(data),"bytes from ${:x}".format(start),"CRC-32: {:08x}".format(snapshot["crc32"]))
+
+   def dictionary_pointers(self):
+      ''' Returns the flash, eeprom and ram 'here' pointers and 'latest' '''
+      pointers = {memory:self.query_number(memory + " here ram") for memory in ("flash","eeprom","ram")}
+      pointers["latest"] = self.query_number("latest @")
+      return pointers
+
+   def read_memory(self,address,length):
+      ''' Read memory 'snapshotBlock' bytes per line with a reader word defined under
+         'marker -ftksnap' and removed afterwards. Returns the bytes read or None if a
+         reply is missing or short.
+      '''
+      self.query("marker -ftksnap")
+      self.query(": ftk-rd base @ >r hex begin ?dup while 1- swap dup c@ u. 1+ swap repeat drop r> base ! ;")
+      data = self.read_memory_blocks(address,length)
+      self.query("-ftksnap") # Remove the reader
+      return data
+
+   def read_memory_blocks(self,address,length):
+      ''' Read memory with 'ftk-rd' '''
+      data = bytearray()
+      while len(data) < length:
+         count = min(self.snapshotBlock,length - len(data))
+         reply = self.query("${:x} #{} ftk-rd".format(address + len(data),count),2.0)
+         try:
+            block = bytes(int(byte,16) for byte in reply.split()[:count])
+         except (AttributeError,ValueError):
+            return None
+         if len(block) < count:
+            return None
+         data.extend(block)
+      return bytes(data)
+
+   def restore(self):
+      ''' Write a '#snapshot' file back to the Forth system without compiling anything.
+         A writer word is defined above the snapshot's end and the current dictionary, then
+         given the start, length, dictionary pointers and 'latest' on a single line followed
+         by the data in hex, which it reads with 'key'. Nothing is looked up in the dictionary
+         while it is being overwritten, and the writer sets the pointers itself once it has
+         finished, leaving itself beyond the restored flash 'here'.
+         Format: #restore file [verify]
+            verify: Read the dictionary back afterwards and compare the CRC-32
+      '''
+      args = self.command_args.split()
+      if not args:
+         return ("Snapshot file name required")
+      try:
+         with open(args[0]) as f:
+            snapshot = json.load(f)
+         data = bytes.fromhex(snapshot["data"])
+         start = snapshot["start"]
+         pointers = snapshot["here"]
+      except (IOError,ValueError,KeyError) as e:
+         return ("Could not read snapshot file: " + str(e))
+      if zlib.crc32(data) != snapshot.get("crc32"):
+         return ("Snapshot file CRC-32 doesn't match its data")
+
+      here = self.query_number("flash here ram")
+      if here == None:
+         return ("Could not read flash here")
+      # The writer goes above both the snapshot and the current dictionary, so compiling it
+      # doesn't overwrite words that are still linked from 'latest'. Only 'ftk-rs' moves back.
+      writer = ["flash ${:x} here - allot ram".format(max(start + len(data),here)),
+                ": ftk-h key dup #58 < if #48 - else #87 - then ;",
+                ": ftk-b ftk-h #4 lshift ftk-h or ;",
+                ": ftk-wr begin ?dup while 1- swap ftk-b over c! 1+ swap repeat drop ;",
+                ": ftk-rs >r >r >r >r ftk-wr r> flash here - allot r> eeprom here - allot",
+                "r> ram here - allot r> latest ! ;"]
+      self.loaderInstalled = False # Check for the '#block' loader again
+      self.errorLine = ""
+      for line in writer:
+         self.query(line)
+      if self.errorLine:
+         return ("Writer failed: " + self.errorLine.strip())
+
+      displayOutput = self.displayOutput  # Save current state of displayOutput
+      self.displayOutput = False
+      line = "${:x} #{} ${:x} ${:x} ${:x} ${:x} ftk-rs\n".format(start,len(data),pointers["flash"],
+                                                                 pointers["eeprom"],pointers["ram"],pointers["latest"])
+      hexData = data.hex().encode('utf-8')
+      with self.sendLock: # Telemetry mustn't send while the writer is reading data with 'key'
+         linesReceived = self.linesReceived
+         self.serial_port.write(line.encode('utf-8'))
+         for i in range(0,len(hexData),256):
+            self.send_xon(hexData[i:i+256])
+            sleep(self.restorePause)
+         deadline = monotonic() + 5.0
+         while self.linesReceived == linesReceived and monotonic() < deadline:
+            self.waitNewline(1,0.1) # The prompt may arrive before waitNewline starts counting
+      self.displayOutput = displayOutput # Restore displayOutput state
+      if self.errorLine:
+         return ("Restore failed: " + self.errorLine.strip())
+      print("Restored:",args[0],len(data),"bytes at ${:x}".format(start))
+
+      if args[1:2] == ["verify"]:
+         readBack = self.read_memory(start,len(data))
+         if readBack == None or zlib.crc32(readBack) != snapshot["crc32"]:
+            return ("Verify failed: data read back doesn't match the snapshot")
+         print("Verified CRC-32: {:08x}".format(snapshot["crc32"]))
+
+   def block_upload(self):
+      ''' Upload a file through a loader on the Forth system instead of line by line. Lines
+         are preprocessed as usual, packed into frames of up to 'blockSize' bytes and sent
+         'blockBatch' frames at a time without echoes or prompts to wait for:
+            SOH, type, sequence, length, payload, CRC-16
+         The type is 'D' for data, 'A' for data to be acknowledged (the last frame of a batch)
+         or 'E' for the last frame, after which the loader returns. The sequence number
+         (mod 64) and length are sent as printable characters, offset by '0' and space, and
+         the CRC-16 (XMODEM, as binascii.crc_hqx) of the type to the payload in hex. The
+         payload is preprocessed source text, so it can't contain SOH and needs no escaping.
+         The loader interprets each good frame in order. It drops bad frames, and those after
+         them, until the next 'A' frame, which it answers with ACK or NAK and the sequence
+         number it expects next, and the host sends the batch again from there.
+         The loader, 'ftk-ld', is compiled the first time it's needed and stays in the
+         dictionary. Lines that may remove it ('empty' or a marker word sent by an upload,
+         e.g. '-lib marker -lib') and lines too long for a frame are sent the usual way.
+         Format: #block file
+      '''
+      pathfile = self.find_file()
+      if not pathfile:
+         return ("File not found: " + self.command_args)
+      if not self.block_install():
+         return ("Loader failed: " + self.errorLine.strip())
+      self.blockStats.clear()
+      start = monotonic()
+      self.blockMode = True
+      try:
+         self.file_upload(pathfile)
+      finally:
+         if self.uploadAborted: # Lines after an error aren't sent
+            self.blockLines = []
+         self.block_end()
+         self.blockMode = False
+      stats = self.blockStats
+      print("Blocks: {} frames, {} bytes, {} sent again in {:.2f}s".format(
+         stats["frames"],stats["bytes"],stats["resent"],monotonic() - start))
+
+   def block_install(self):
+      ''' Compile the '#block' loader unless it's already on the Forth system.
+         Returns False if it couldn't be compiled.
+      '''
+      errorLine = self.errorLine
+      self.errorLine = ""
+      if not self.loaderInstalled:
+         self.query("' ftk-ld drop")
+         self.loaderInstalled = not self.errorLine
+         self.errorLine = ""
+      if not self.loaderInstalled:
+         loader = ["ram create ftk-buf #96 allot",
+                   "variable ftk-cr variable ftk-sq variable ftk-er variable ftk-ty variable ftk-n",
+                   ": ftk-c #8 lshift ftk-cr @ xor #8 for dup $8000 and if 2* $1021 xor else 2* then next $ffff and ftk-cr ! ;",
+                   ": ftk-k key dup ftk-c ;",
+                   ": ftk-x key dup #58 < if #48 - else #87 - then ;",
+                   ": ftk-x4 #0 #4 for #4 lshift ftk-x or next ;",
+                   ": ftk-rx begin key #1 = until #0 ftk-cr ! ftk-k ftk-ty ! ftk-k #48 - ftk-k #32 - #0 max #95 min",
+                   "dup ftk-n ! ftk-buf swap begin ?dup while 1- swap ftk-k over c! 1+ swap repeat drop",
+                   "ftk-cr @ ftk-x4 = swap ftk-sq @ = and ;",
+                   ": ftk-ld #0 ftk-sq ! #0 ftk-er ! begin ftk-rx",
+                   "if ftk-buf ftk-n @ interpret ftk-sq @ 1+ #63 and ftk-sq ! ftk-ty @ #69 = else #-1 ftk-er ! #0 then",
+                   "ftk-ty @ dup #65 = swap #69 = or if ftk-er @ if #21 else #6 then emit ftk-sq @ #48 + emit #0 ftk-er ! then",
+                   "until ;"]
+         for line in loader:
+            self.query(line)
+         self.loaderInstalled = not self.errorLine
+      if self.loaderInstalled:
+         self.errorLine = errorLine
+      return self.loaderInstalled
+
+   def block_line(self,text):
+      ''' Add a preprocessed line to the next frame, sending a batch when it's full '''
+      self.track_definition(text)
+      words = text.split()
+      rollback = any(word == "empty" or (word in self.markers and words[i-1:i] != ["marker"])
+                     for i,word in enumerate(words)) # Running a marker, not defining it
+      if rollback or len(text.encode('utf-8')) > self.blockSize:
+         self.block_end()
+         self.send_data(text)
+         if rollback:
+            self.loaderInstalled = False # It may have been removed, check before starting it again
+         return
+      if self.blockLines and len(" ".join(self.blockLines + [text]).encode('utf-8')) > self.blockSize:
+         self.blockFrames.append(self.blockLines)
+         self.blockLines = []
+         if len(self.blockFrames) == self.blockBatch and not self.block_send("A"):
+            return # Stopped by an error
+      self.blockLines.append(text)
+
+   def block_end(self):
+      ''' Send any lines waiting in an 'E' frame so the loader returns '''
+      if self.blockLines:
+         self.blockFrames.append(self.blockLines)
+         self.blockLines = []
+      if self.loaderActive or self.blockFrames:
+         if not self.blockFrames:
+            self.blockFrames.append([])
+         linesReceived = self.linesReceived
+         if self.block_send("E"):
+            self.loaderActive = False
+            deadline = monotonic() + 0.3
+            while self.linesReceived == linesReceived and monotonic() < deadline:
+               self.waitNewline(1,0.05) # The prompt after 'ftk-ld'
+
+   def block_frame(self,kind,seq,lines):
+      ''' Returns a frame for the loader '''
+      payload = " ".join(lines).encode('utf-8')
+      body = kind.encode('utf-8') + bytes((0x30 + seq % 64,0x20 + len(payload))) + payload
+      return b"\x01" + body + "{:04x}".format(binascii.crc_hqx(body,0)).encode('utf-8')
+
+   def block_send(self,last):
+      ''' Send the frames in 'blockFrames', the last one of type 'last', until the loader
+         has acknowledged them all. Returns False if the upload was stopped by an error.
+      '''
+      if not self.loaderActive:
+         if not self.loaderInstalled and not self.block_install(): # Removed e.g. by a marker
+            self.block_drop()
+            return False
+         self.serial_port.write(b"ftk-ld\n")
+         self.loaderActive = True
+         self.blockSeq = 0
+         self.blockPending = b""
+         while not self.blockReplies.empty(): # Replies left over from an earlier upload
+            self.blockReplies.get()
+      retries = 0
+      sent = 0 # Frames sent before, the rest are new
+      while self.blockFrames:
+         frames = b"".join(self.block_frame("D" if i < len(self.blockFrames) - 1 else last,
+                                            self.blockSeq + i,lines)
+                           for i,lines in enumerate(self.blockFrames))
+         self.blockStats["frames"] += len(self.blockFrames)
+         self.blockStats["resent"] += min(sent,len(self.blockFrames))
+         self.blockStats["bytes"] += len(frames)
+         sent = len(self.blockFrames)
+         self.send_xon(frames)
+         reply = self.block_reply()
+         if reply == None:
+            return False
+         if reply[0] == None and last == "E" and self.loader_returned(): # The ACK was lost
+            reply = (True,(self.blockSeq + len(self.blockFrames)) % 64)
+         acked = (reply[1] - self.blockSeq) % 64
+         if acked > len(self.blockFrames): # Out of date reply, send the batch again
+            acked = 0
+         self.blockSeq += acked
+         del self.blockFrames[:acked]
+         if acked:
+            retries = 0
+         elif self.blockFrames:
+            retries += 1
+            if retries > self.blockRetries:
+               sys.stderr.write('--- No acknowledgement from the loader after {} tries ---\n'.format(retries))
+               self.block_abort()
+               self.uploadAborted = True
+               self.errors += 1
+               return False
+      return True
+
+   def block_reply(self):
+      ''' Wait for the loader to reply to a batch. Returns (ack, sequence), (None, blockSeq)
+         if nothing arrives in time so the batch is sent again, or None after an error,
+         which also stops the loader.
+      '''
+      start = monotonic()
+      deadline = start + self.blockTimeout
+      while monotonic() < deadline:
+         if self.errorLine:
+            self.serial_wait(start)
+            self.block_abort()
+            return None
+         try:
+            reply = self.blockReplies.get(timeout=0.05)
+            self.serial_wait(start)
+            return reply
+         except queue.Empty:
+            pass
+      self.serial_wait(start)
+      return (None,self.blockSeq % 64)
+
+   def loader_returned(self):
+      ''' Send a NL and look for the prompt. The loader ignores anything before SOH, so
+         there's only a prompt if the loader has returned, e.g. if the ACK for the 'E' frame
+         was lost and sending the frame again would be read as text.
+      '''
+      linesReceived = self.linesReceived
+      self.serial_port.write(b"\n")
+      deadline = monotonic() + 0.5
+      while self.linesReceived == linesReceived and monotonic() < deadline:
+         self.waitNewline(1,0.05)
+      return self.linesReceived != linesReceived and " ok" in self.lastLines[-1]
+
+   def block_abort(self):
+      ''' The loader stopped on an error, or stopped answering. Frames still arriving are
+         read as text by the Forth system. Each starts with SOH and the frame header, which
+         is never a valid word, so sending a NL gets rid of them with another error.
+      '''
+      errorLine = self.errorLine
+      self.loaderActive = False
+      self.block_drop()
+      self.waitIdle(0.3,5.0)
+      self.serial_port.write(b"\n")
+      self.waitNewline(1,0.3)
+      self.errorLine = errorLine # The error to report, not the one for the frames
+
+   def block_drop(self):
+      ''' Forget the lines waiting to be sent or acknowledged after an error, reporting
+         them as they may not have been interpreted. They are the last lines sent.
+      '''
+      count = sum(len(lines) for lines in self.blockFrames) + len(self.blockLines)
+      self.blockFrames = []
+      self.blockLines = []
+      if count:
+         dropped = self.sentLines[-count:]
+         last = "line {}".format(dropped[-1][1])
+         if dropped[-1][0] != dropped[0][0]:
+            last = "{} {}".format(dropped[-1][0],last)
+         sys.stderr.write('--- {} lines may not have been interpreted: {} line {} to {} ---\n'.format(
+            count,dropped[0][0],dropped[0][1],last))
+         self.progress("dropped",file=dropped[0][0],line=dropped[0][1],lines=count)
+
+   def time_word(self):
+      ''' Time a word on the Forth system. A timing wrapper is uploaded which reads a counter
+         before and after running the word, N times, printing the raw counts. The same loop
+         without the word measures the overhead, which is subtracted.
+         Format: #time word [iterations] [counter]
+            word      : Word to time. It must leave the stack unchanged
+            iterations: Number of times to run the word (default: 100)
+            counter   : A register from MCUREGS e.g. TCNT1 (default), TCNT0, TCNT2, or a word
+                        which returns a count e.g. ticks (milliseconds in flashforth)
+         Timer counters must be running. Counts are converted to microseconds using the
+         timer prescaler and 'cpuClock'. 8 bit counters wrap after 256 counts.
+      '''
+      args = self.command_args.split()
+      if not args:
+         return ("Word to time required e.g. #time myword 100")
+      word = args[0]
+      iterations = args[1] if len(args) > 1 else "100"
+      counter = args[2] if len(args) > 2 else "TCNT1"
+      if not iterations.isdigit() or int(iterations) < 1:
+         return ("Invalid number of iterations: " + iterations)
+
+      tick = counter # A word which returns a count
+      mask = "" # Counts are 16 bit unless the register is 8 bit
+      if counter in MCUREGS:
+         if counter in self.wideRegisters:
+            tick = MCUREGS[counter] + " @"
+         else:
+            tick = MCUREGS[counter] + " c@"
+            mask = " $ff and"
+      microseconds = None # Microseconds per count if known
+      if counter in self.timerPrescalers:
+         control,prescalers = self.timerPrescalers[counter]
+         reply = self.query(MCUREGS[control] + " c@ #7 and base @ swap decimal u. base !")
+         try:
+            prescaler = prescalers[int(reply.split()[0])]
+         except (AttributeError,IndexError,ValueError):
+            prescaler = None
+         if prescaler == 0:
+            return ("Timer stopped: set the clock select bits in " + control)
+         if prescaler:
+            microseconds = prescaler * 1000000 / self.cpuClock
+
+      wrapper = ["marker -ftktime",
+                 ": ftk-tick " + tick + " ;",
+                 ": ftk-time base @ >r decimal for ftk-tick " + word + " ftk-tick swap -" + mask + " u. next r> base ! ;",
+                 ": ftk-loop base @ >r decimal for ftk-tick ftk-tick swap -" + mask + " u. next r> base ! ;"]
+      self.errorLine = ""
+      for line in wrapper:
+         self.query(line)
+         if self.errorLine: # e.g. the word isn't defined
+            error = self.errorLine.strip()
+            self.errorLine = ""
+            self.query("-ftktime")
+            return ("Timing wrapper failed: " + error)
+      counts = self._counts(self.query("#" + iterations + " ftk-time",self.timeTimeout))
+      overhead = self._counts(self.query("#" + iterations + " ftk-loop",self.timeTimeout))
+      self.query("-ftktime") # Remove the wrapper
+      if not counts or not overhead:
+         return ("No timing results received")
+
+      loop = statistics.median(overhead)
+      counts = sorted(max(count - loop,0) for count in counts)
+      print("Timing '" + word + "' x",len(counts),"using",counter,"- loop overhead of",loop,"counts subtracted")
+      for name,count in (("min",counts[0]),("median",statistics.median(counts)),("max",counts[-1])):
+         if microseconds:
+            print("   {:<7} {:>8} counts {:>12.2f} us".format(name,count,count * microseconds))
+         else:
+            print("   {:<7} {:>8} counts".format(name,count))
+
+   def _counts(self,reply):
+      ''' Returns the counts printed by the timing wrapper '''
+      counts = []
+      for count in (reply or "").split():
+         if count.isdigit():
+            counts.append(int(count))
+      return counts
+
+   def telemetry_command(self):
+      ''' Background sampling of free memory while the link is idle.
+         Arguments:
+            No args   : Print the samples taken
+            on [secs] : Start sampling every 'secs' seconds (default: 10)
+            off       : Stop sampling
+            size n    : Keep the last n samples (default: 1000)
+            csv file  : Save the samples to a CSV file
+            clear     : Delete the samples
+      '''
+      args = self.command_args.split()
+      if not args:
+         print("Telemetry:","on" if self.telemetryStop else "off",len(self.telemetry),"samples")
+         for sample in self.telemetry:
+            print(strftime("%H:%M:%S",localtime(sample[0])),"flash:",sample[1],"eeprom:",sample[2],"ram:",sample[3])
+      elif args[0] == "on":
+         if len(args) > 1:
+            try:
+               self.telemetryInterval = float(args[1])
+            except ValueError:
+               return ("Invalid interval: " + args[1])
+         if not self.telemetryStop:
+            self.telemetryStop = threading.Event()
+            threading.Thread(target=self._telemetry,args=(self.telemetryStop,)).start()
+      elif args[0] == "off":
+         if self.telemetryStop:
+            self.telemetryStop.set()
+            self.telemetryStop = None
+      elif args[0] == "size" and len(args) > 1 and args[1].isdigit():
+         self.telemetry = collections.deque(self.telemetry,maxlen=int(args[1]))
+      elif args[0] == "csv" and len(args) > 1:
+         try:
+            with open(args[1],'w',newline='') as f:
+               writer = csv.writer(f)
+               writer.writerow(["time","flash","eeprom","ram"])
+               for sample in list(self.telemetry):
+                  writer.writerow([strftime("%Y-%m-%d %H:%M:%S",localtime(sample[0]))] + list(sample[1:]))
+         except IOError as e:
+            return ("Could not write CSV file: " + str(e))
+      elif args[0] == "clear":
+         self.telemetry.clear()
+      else:
+         return ("Unknown telemetry argument: " + self.command_args)
+
+   def footprint_command(self):
+      ''' Memory footprint profiling. While on, the free flash, eeprom and ram are read before
+         and after each file uploaded (and optionally each definition) to find the memory used.
+         Arguments:
+            No args       : Print the footprint table, largest flash users first
+            on            : Profile each file uploaded
+            words         : Profile each file and each definition (slower)
+            off           : Stop profiling
+            save file     : Save the footprints to a JSON file
+            compare file  : Print the change in footprint of each file since a saved JSON file
+            clear         : Delete the footprints
+      '''
+      args = self.command_args.split()
+      if not args:
+         self.footprint_table()
+      elif args[0] in ("on","files"):
+         self.footprint = "files"
+      elif args[0] == "words":
+         self.footprint = "words"
+      elif args[0] == "off":
+         self.footprint = None
+      elif args[0] == "clear":
+         self.footprintFiles = {}
+         self.footprintWords = {}
+      elif args[0] in ("save","compare") and len(args) > 1:
+         try:
+            if args[0] == "save":
+               with open(args[1],'w') as f:
+                  json.dump({"files":self.footprintFiles,"words":self.footprintWords},f,indent=1,sort_keys=True)
+            else:
+               with open(args[1]) as f:
+                  self.footprint_compare(json.load(f))
+         except (IOError,ValueError) as e:
+            return ("Could not " + args[0] + " footprint file: " + str(e))
+      else:
+         return ("Unknown footprint argument: " + self.command_args)
+
+   def footprint_file(self):
+      ''' Record the memory used by the file just uploaded, not counting the files it included '''
+      filename,before,included = self.footprintStack.pop()
+      after = self.memory_snapshot()
+      used = self.memory_used(before,after)
+      if self.footprintStack: # Add to the memory used by files included by the parent file
+         parentIncluded = self.footprintStack[-1][2]
+         for memory in used:
+            parentIncluded[memory] = parentIncluded.get(memory,0) + used[memory]
+      self.footprintFiles[filename] = {memory:used[memory] - included.get(memory,0) for memory in used}
+
+   def footprint_line(self,filename,text):
+      ''' Send a line, reading the free memory before a definition starts and after it ends.
+         Memory can't be read in the middle of a definition as the query would be compiled.
+      '''
+      splitLine = text.split()
+      words = []
+      ending = False
+      for i in range(len(splitLine)):
+         word = splitLine[i]
+         if (word in self.compileWords or word == ":") and i+1 < len(splitLine):
+            words.append(splitLine[i+1])
+         if word == ";" or word == ";i" or word in self.compileWords:
+            ending = True
+      if words and not self.footprintDefinition:
+         self.footprintDefinition = (" ".join(words),self.memory_snapshot())
+      self.send_data(text)
+      if ending and self.footprintDefinition and not self.errorLine:
+         words,before = self.footprintDefinition
+         self.footprintDefinition = None
+         used = self.memory_used(before,self.memory_snapshot())
+         self.footprintWords.setdefault(filename,{})[words] = used
+
+   def memory_used(self,before,after):
+      ''' Memory used between two memory_snapshots, i.e. the decrease in free memory '''
+      return {memory:before[memory] - after[memory] if before[memory] != None and after[memory] != None else 0 for memory in before}
+
+   def footprint_table(self):
+      ''' Print the memory used by each file, and each definition if profiled, largest first '''
+      print("Footprint (bytes)                        flash  eeprom     ram")
+      for filename in sorted(self.footprintFiles,key=lambda f:-self.footprintFiles[f]["flash"]):
+         used = self.footprintFiles[filename]
+         print("{:<38} {:>7} {:>7} {:>7}".format(filename,used["flash"],used["eeprom"],used["ram"]))
+         words = self.footprintWords.get(filename,{})
+         for word in sorted(words,key=lambda w:-words[w]["flash"]):
+            used = words[word]
+            print("   {:<35} {:>7} {:>7} {:>7}".format(word,used["flash"],used["eeprom"],used["ram"]))
+
+   def footprint_compare(self,saved):
+      ''' Print the change in memory used by each file since a saved footprint '''
+      savedFiles = saved.get("files",{})
+      print("Footprint change (bytes)                 flash  eeprom     ram")
+      for filename in sorted(set(savedFiles) | set(self.footprintFiles)):
+         old = savedFiles.get(filename,{})
+         new = self.footprintFiles.get(filename,{})
+         change = [new.get(memory,0) - old.get(memory,0) for memory in ("flash","eeprom","ram")]
+         if any(change):
+            print("{:<38} {:>+7} {:>+7} {:>+7}".format(filename,*change))
+
+   def _telemetry(self,stop):
+      ''' Sampler thread. Skips a sample if anything else is being sent or something has been
+         received recently, so traffic in flight isn't disturbed, or while a definition is open
+         as the queries would be compiled into it.
+      '''
+      sampled = 0.0 # Time the last sample finished, its own replies don't count as traffic
+      while not stop.wait(self.telemetryInterval) and not self.exit:
+         if self.lastReceived > sampled and monotonic() - self.lastReceived < self.telemetryIdle:
+            continue
+         if self.definitionOpen:
+            continue
+         if self.sendLock.acquire(blocking=False):
+            try:
+               if self.definitionOpen: # Checked again now nothing else can be sent
+                  continue
+               stats = self.memory_snapshot()
+               self.telemetry.append((time(),stats["flash"],stats["eeprom"],stats["ram"]))
+               sampled = monotonic()
+            finally:
+               self.sendLock.release()
 
    def file_upload(self,filename):
+      ''' Uploads a file to the Forth system. Reading and preprocessing is done by a separate
+         read ahead thread (see '_read_ahead') which fills a bounded queue, so this thread only
+         has to send lines and run commands as they come off the queue. Items are tuples:
+         (kind, filename, line number, source line, text) where kind is one of 'start',
+         'line', 'command', 'end' or 'error'. None marks the end of the upload. The read ahead
+         thread waits for each command to be run, as it may change how later lines are
+         preprocessed, e.g. '#lits' or '#path'.
+      '''
       if filename:
+         if self.uploadDepth == 0: # Top level upload, clear any previous error
+            self.errorLine = ""
+            self.uploadAborted = False
+            self.sentLines = []
+            self.lastMarker = "" # Rollback only removes this upload, not an earlier one
+         self.uploadDepth += 1
+         uploadQueue = queue.Queue(self.uploadQueueSize)
+         stopReading = threading.Event() # Tells the read ahead thread to give up, e.g. on error
+         commandRun = threading.Event() # Tells the read ahead thread the last command has been run
+         threading.Thread(target=self._read_ahead, args=(filename,uploadQueue,stopReading,commandRun)).start()
          try:
-            with open(filename, 'rb') as f:
-               self.output(' ===> Reading file: ',filename, "\n")
-               while True:
-                  line = f.readline()
-                  if not line:
-                     break                 
-                  current_line = LineProcessor(line.decode('utf-8'))
-                  if current_line.is_command:
-                     self.output("Command: ",current_line.text)
-                     self.run_command(current_line.text)
+            while not self.uploadAborted:
+               item = uploadQueue.get()
+               if item == None: # Read ahead thread has finished
+                  break
+               kind,filename,lineNumber,source,text = item
+               if kind == "start":
+                  self.output(' ===> Reading file: ',filename, "\n")
+                  self.progress("file",file=filename)
+                  name = os.path.basename(filename)
+                  if name in self.uploadOrder:
+                     self.uploadOrder.remove(name)
+                  self.uploadOrder.append(name)
+                  if self.footprint:
+                     self.footprintStack.append([filename,self.memory_snapshot(),{}])
+               elif kind == "command":
+                  if self.blockMode: # Commands talk to the Forth system directly
+                     self.block_end()
+                     if self.errorLine:
+                        self.upload_error(filename)
+                        if self.uploadAborted:
+                           break
+                  self.output("Command: ",text)
+                  self.run_command(text)
+                  commandRun.set()
+               elif kind == "line":
+                  self.sent_line(filename,lineNumber,source,text)
+                  if self.footprint == "words":
+                     self.footprint_line(filename,text)
+                  elif self.blockMode:
+                     self.block_line(text)
+                  else:
+                     self.send_data(text)
+                  if lineNumber % self.progressLines == 0:
+                     self.progress("line",file=filename,line=lineNumber)
+                  if self.errorLine:
+                     self.upload_error(filename)
+               elif kind == "end":
+                  if self.blockMode:
+                     self.block_end()
+                  if self.flowControl != "newline": # Let the Forth system catch up with the lines streamed
+                     self.waitIdle(0.3,30.0)
+                  else:
+                     self.waitNewline(1,0.3) # 1 x NL or 0.3 secs - give the system time to respond
+                  if self.errorLine: # Error on the last line of the file
+                     self.upload_error(filename)
                   else:
-                     if (current_line.strip_comments()): # Returns False if line is empty
-                        current_line.substitute_registers() # Substitute registers with literals
-                        current_line.hex_convert() # Convert any upper case hex to lower case
-                        self.send_data(current_line.text)
-            self.waitNewline(1,0.3) # 1 x NL or 0.3 secs - give the system time to respond
-            self.output(' ===> Finished reading file: ',filename,"\n")
+                     self.output(' ===> Finished reading file: ',filename,"\n")
+                     self.progress("finished",file=filename,lines=lineNumber)
+                  if self.footprint and self.footprintStack:
+                     self.footprint_file()
+               elif kind == "error": # The file couldn't be read
+                  sys.stderr.write('--- ERROR reading file {}: {} ---\n'.format(filename, text))
+                  self.errors += 1
+                  self.progress("error",file=filename,message=text)
+                  self.uploadAborted = True
+                  sys.stderr.write('--- Upload stopped ---\n')
+         finally:
+            stopReading.set()
+            self.uploadDepth -= 1
+            if self.uploadDepth == 0: # Files not finished because of an error aren't profiled
+               self.footprintStack = []
+               self.footprintDefinition = None
+
+   def _read_ahead(self,filename,uploadQueue,stopReading,commandRun):
+      ''' Read ahead thread for file_upload. Preprocesses the file (and any files it includes)
+         into 'uploadQueue', then puts None to mark the end of the upload.
+      '''
+      profiler = None
+      profiling = self.profileActive # Profile this thread as part of the command being profiled
+      cpu = thread_time()
+      try:
+         if profiling:
+            try:
+               profiler = cProfile.Profile()
+               profiler.enable()
+            except ValueError: # Python 3.12+ allows one active profiler, only the CPU time is counted
+               profiler = None
+         self._read_file(filename,uploadQueue,stopReading,commandRun,[])
+      finally:
+         if profiler:
+            profiler.disable()
+            self.readAheadProfiles.append(profiler)
+         if profiling:
+            self.readAheadCPU += thread_time() - cpu
+         self._queue_put(uploadQueue,None,stopReading)
+
+   def _read_file(self,filename,uploadQueue,stopReading,commandRun,including):
+      ''' Read a whole file in one go and queue its preprocessed lines. Nested '#send',
+         '#include' and '#require' commands are expanded in place if the file can be found
+         now, otherwise they are queued as commands to be run in order by file_upload,
+         waiting for each to be run before reading on.
+         'including' lists the files being expanded, to stop a file including itself.
+      '''
+      try:
+         with open(filename, 'rb') as f:
+            lines = f.read().decode('utf-8').splitlines()
+      except (IOError,UnicodeDecodeError) as e:
+         self._queue_put(uploadQueue,("error",filename,0,"",str(e)),stopReading)
+         return
 
-         except IOError as e:
-            sys.stderr.write('--- ERROR opening file {}: {} ---\n'.format(filename, e))
+      self._queue_put(uploadQueue,("start",filename,0,"",""),stopReading)
+      for lineNumber,line in enumerate(lines,1):
+         if stopReading.is_set():
+            return
+         current_line = LineProcessor(line)
+         if current_line.is_command:
+            command,_,args = current_line.text.partition(" ")
+            pathfile = None
+            if command in ("#send","#include","#require") and args:
+               pathfile = self.find_file(args)
+            if pathfile and pathfile not in including and pathfile != filename:
+               self._read_file(pathfile,uploadQueue,stopReading,commandRun,including + [filename])
+            else:
+               commandRun.clear()
+               self._queue_put(uploadQueue,("command",filename,lineNumber,line,current_line.text),stopReading)
+               while not commandRun.wait(0.1) and not stopReading.is_set():
+                  pass # Later lines may depend on the command e.g. '#lits'
+         elif current_line.strip_comments(): # Returns False if line is empty
+            current_line.substitute_registers() # Substitute registers with literals
+            current_line.hex_convert() # Convert any upper case hex to lower case
+            self._queue_put(uploadQueue,("line",filename,lineNumber,line,current_line.text),stopReading)
+      self._queue_put(uploadQueue,("end",filename,len(lines),"",""),stopReading)
+
+   def _queue_put(self,uploadQueue,item,stopReading):
+      ''' Put an item on the upload queue, waiting while it is full unless the upload is stopped '''
+      while not stopReading.is_set():
+         try:
+            uploadQueue.put(item,timeout=0.1)
+            return
+         except queue.Full:
+            pass
+
+   def sent_line(self,filename,lineNumber,source,text):
+      ''' Remember a line sent during an upload so an error can be traced back to its source,
+         and note any 'marker' word defined by it for rolling back.
+      '''
+      self.sentLines.append((filename,lineNumber,source.rstrip("\n\r"),text))
+      maxLines = self.maxLastLines
+      if self.blockMode: # Keep every line that may still be in a frame in flight
+         maxLines += (self.blockBatch + 1) * self.blockSize // 2
+      while len(self.sentLines) > maxLines:
+         del self.sentLines[0] # Delete oldest line
+      splitLine = text.split()
+      for i in range(len(splitLine)-1):
+         if splitLine[i] == "marker":
+            self.lastMarker = splitLine[i+1]
+            self.markers.add(splitLine[i+1])
+
+   def upload_error(self,filename):
+      ''' Report an error received during an upload. The error line starts with the echo of
+         the line that caused it, so search the recently sent lines for a match. Depending on
+         'self.onError' the upload is stopped and optionally rolled back to the last marker.
+      '''
+      errorLine = self.errorLine
+      self.errorLine = ""
+      lineNumber,source = "?",""
+      if self.sentLines: # Default to the last line sent
+         filename,lineNumber,source,text = self.sentLines[-1]
+      for sent in reversed(self.sentLines):
+         if sent[3] and sent[3] in errorLine:
+            filename,lineNumber,source,text = sent
+            break
+      else: # No echo, e.g. lines sent by '#block', so look for the offending word instead
+         word = errorLine.rstrip()[:-1].split()[-1:]
+         for sent in reversed(self.sentLines):
+            if word and word[0] in sent[3].split():
+               filename,lineNumber,source,text = sent
+               break
+      sys.stderr.write('--- ERROR in file {} line {}: {} ---\n'.format(filename, lineNumber, errorLine.strip()))
+      sys.stderr.write('    {}\n'.format(source))
+      self.errors += 1
+      self.progress("error",file=filename,line=lineNumber,source=source,message=errorLine.strip())
+      if self.onError == "continue":
+         return
+      self.uploadAborted = True
+      sys.stderr.write('--- Upload stopped ---\n')
+      if self.onError == "rollback" and self.lastMarker:
+         sys.stderr.write('--- Rolling back to marker: {} ---\n'.format(self.lastMarker))
+         self.send_data(self.lastMarker)
+         self.lastMarker = ""
 
    ''' ======================== End Command Methods ======================= '''
 
@@ -704,7 +2399,315 @@ class LineProcessor(ForthTalk):
       self.text = newLine[:-1] # Hex conversion complete
       return self.text
 
-forthtalk = ForthTalk()
+class WordTrie():
+   ''' Prefix tree of words. Each node is a dictionary of next characters, with the key
+      '' marking the end of a word, so finding all words with a prefix only visits the
+      nodes below the prefix rather than every word.
+   '''
+
+   def __init__(self,words=()):
+      self.root = {}
+      self.count = 0
+      for word in words:
+         self.add(word)
+
+   def add(self,word):
+      node = self.root
+      for c in word:
+         node = node.setdefault(c,{})
+      if "" not in node:
+         node[""] = True
+         self.count += 1
+
+   def remove(self,word):
+      path = [self.root]
+      for c in word:
+         if c not in path[-1]:
+            return
+         path.append(path[-1][c])
+      if "" not in path[-1]:
+         return
+      del path[-1][""]
+      self.count -= 1
+      for i in range(len(word),0,-1): # Delete nodes no longer leading to a word
+         if path[i]:
+            break
+         del path[i-1][word[i-1]]
+
+   def __contains__(self,word):
+      node = self.root
+      for c in word:
+         if c not in node:
+            return False
+         node = node[c]
+      return "" in node
+
+   def __len__(self):
+      return self.count
+
+   def find(self,prefix):
+      ''' Returns a sorted list of all words starting with prefix '''
+      node = self.root
+      for c in prefix:
+         if c not in node:
+            return []
+         node = node[c]
+      words = []
+      stack = [(prefix,node)]
+      while stack:
+         word,node = stack.pop()
+         for c in node:
+            if c == "":
+               words.append(word)
+            else:
+               stack.append((word + c,node[c]))
+      return sorted(words)
+
+class TerminalRenderer():
+   ''' Writes output to the terminal from its own thread. write() only adds text to a bounded
+      buffer, so the receive thread never waits on a slow terminal or SSH session. The thread
+      writes everything buffered in one go, at most 'frameRate' times a second. If the buffer
+      overflows further text is dropped and a summary of how much was dropped is displayed.
+   '''
+
+   def __init__(self,stream,maxBuffer=65536,frameRate=30):
+      self.stream = stream
+      self.maxBuffer = maxBuffer # Maximum characters waiting to be displayed
+      self.frameTime = 1.0 / frameRate
+      self.buffer = [] # Text waiting to be displayed
+      self.buffered = 0 # Characters in buffer
+      self.droppedChars = 0 # Characters dropped since last displayed
+      self.droppedLines = 0
+      self.lock = threading.Lock()
+      self.ready = threading.Event() # Set when there is something to display
+      self.written = threading.Condition(self.lock) # Notified when the buffer has been displayed
+      self.running = True
+      # A daemon thread, so an error elsewhere can't leave the program waiting on the terminal
+      self.thread = threading.Thread(target=self._render,daemon=True)
+      self.thread.start()
+
+   def write(self,text):
+      if not text:
+         return
+      with self.lock:
+         if self.buffered + len(text) > self.maxBuffer:
+            self.droppedChars += len(text)
+            self.droppedLines += text.count("\n")
+         else:
+            self.buffer.append(text)
+            self.buffered += len(text)
+      self.ready.set()
+
+   def flush(self,timeout=1.0):
+      ''' Wait until everything buffered has been displayed '''
+      with self.lock:
+         if self.buffer or self.droppedChars:
+            self.ready.set()
+            self.written.wait(timeout)
+
+   def stop(self):
+      ''' Display anything still buffered and stop the thread '''
+      self.running = False
+      self.ready.set()
+      self.thread.join(1.0) # Let the last render finish before the program exits
+
+   def _render(self):
+      running = True
+      while running:
+         self.ready.wait()
+         self.ready.clear()
+         running = self.running # Render once more after stop()
+         start = monotonic()
+         with self.lock:
+            text = "".join(self.buffer)
+            if self.droppedChars:
+               text += "\n[ {} characters ({} lines) not displayed ]\n".format(self.droppedChars,self.droppedLines)
+            self.buffer = []
+            self.buffered = 0
+            self.droppedChars = 0
+            self.droppedLines = 0
+         if text:
+            self.stream.write(text)
+            self.stream.flush()
+         with self.lock:
+            if not self.buffer:
+               self.written.notify_all()
+         sleep(max(0.0,self.frameTime - (monotonic() - start))) # Cap the frame rate
+
+class TraceRecorder():
+   ''' Wraps a serial port and records every byte sent and received to a trace file.
+      The trace is a header (TRACE_MAGIC) followed by records of: direction (b'w' sent,
+      b'r' received), microseconds since the previous record, data length and the data.
+      Everything else is passed through to the serial port.
+   '''
+
+   def __init__(self,port,filename):
+      self.__dict__["port"] = port # Set directly as __setattr__ passes attributes to the port
+      self.__dict__["filename"] = filename
+      self.__dict__["trace"] = open(filename,'wb')
+      self.__dict__["lock"] = threading.Lock() # Data is sent and received from different threads
+      self.__dict__["lastTime"] = monotonic()
+      self.__dict__["stopped"] = False # Set by stop(), a read may still be waiting on the port
+      self.trace.write(TRACE_MAGIC)
+
+   def __getattr__(self,name):
+      return getattr(self.port,name)
+
+   def __setattr__(self,name,value):
+      setattr(self.port,name,value) # e.g. baudrate
+
+   def read(self,size=1):
+      data = self.port.read(size)
+      if data:
+         self._record(b"r",data)
+      return data
+
+   def write(self,data):
+      self._record(b"w",data)
+      return self.port.write(data)
+
+   def _record(self,direction,data):
+      with self.lock:
+         if self.stopped:
+            return
+         now = monotonic()
+         delta = int((now - self.lastTime) * 1000000)
+         self.__dict__["lastTime"] = now
+         for i in range(0,len(data),0xffff): # Length is 16 bits
+            self.trace.write(TRACE_RECORD.pack(direction,min(delta,0xffffffff),len(data[i:i+0xffff])))
+            self.trace.write(data[i:i+0xffff])
+            delta = 0
+
+   def stop(self):
+      ''' Stop recording and return the serial port '''
+      with self.lock:
+         self.__dict__["stopped"] = True
+         self.trace.close()
+      return self.port
+
+   def close(self):
+      self.stop()
+      self.port.close()
+
+class TracePort():
+   ''' A fake serial port which replays the data received in a trace recorded by TraceRecorder,
+      so a session can be reproduced without a Forth system. The data received after each NL
+      sent in the trace is held back until forthtalk sends the same number of NLs, then
+      released with its original timing relative to that NL or, if 'realTime' is False, as
+      fast as possible. Data sent by forthtalk is otherwise ignored.
+   '''
+
+   def __init__(self,filename,baudrate=38400,realTime=True):
+      self.filename = filename
+      self.baudrate = baudrate
+      self.timeout = 0.1
+      self.realTime = realTime
+      self.segments = [[]] # Received data after each NL sent: [[(seconds after NL, data),...],...]
+      with open(filename,'rb') as f:
+         if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError("Not a forthtalk trace file: " + filename)
+         elapsed = 0.0 # Time since the last NL sent
+         while True:
+            header = f.read(TRACE_RECORD.size)
+            if len(header) < TRACE_RECORD.size:
+               break
+            direction,delta,length = TRACE_RECORD.unpack(header)
+            data = f.read(length)
+            elapsed += delta / 1000000
+            if direction == b"r":
+               self.segments[-1].append((elapsed,data))
+            elif b"\n" in data:
+               for i in range(data.count(b"\n")):
+                  self.segments.append([])
+               elapsed = 0.0
+      self.nlTimes = [monotonic()] # Time forthtalk sent each NL, starting with the time opened
+      self.segment = 0 # Current segment and position within it
+      self.position = 0
+      self.buffer = b"" # Data released but not yet read
+
+   def _release(self):
+      ''' Move received data that is due from the trace to the buffer '''
+      now = monotonic()
+      while self.segment < len(self.nlTimes) and self.segment < len(self.segments):
+         records = self.segments[self.segment]
+         while self.position < len(records):
+            offset,data = records[self.position]
+            if self.realTime and self.nlTimes[self.segment] + offset > now:
+               return
+            self.buffer += data
+            self.position += 1
+         self.segment += 1
+         self.position = 0
+
+   @property
+   def in_waiting(self):
+      self._release()
+      return len(self.buffer)
+
+   @property
+   def finished(self):
+      ''' True when all the received data in the trace has been replayed '''
+      return self.segment >= len(self.segments)
+
+   def read(self,size=1):
+      deadline = monotonic() + self.timeout
+      self._release()
+      while not self.buffer and monotonic() < deadline:
+         sleep(0.005)
+         self._release()
+      data = self.buffer[:size]
+      self.buffer = self.buffer[size:]
+      return data
+
+   def write(self,data):
+      for i in range(data.count(b"\n")):
+         self.nlTimes.append(monotonic())
+      return len(data)
+
+   def flush(self):
+      pass
+
+   def reset_input_buffer(self):
+      self._release()
+      self.buffer = b""
+
+   def close(self):
+      pass
+
+TRACE_MAGIC = b"FTKTRACE\x01" # Trace file header and version
+TRACE_RECORD = struct.Struct("<cIH") # Direction, microseconds since previous record, length
+
+def load_device(name):
+   ''' Load the register names for a device e.g. '328p' from device328p.py into MCUREGS '''
+   try:
+      device = importlib.import_module("device" + name)
+   except ImportError:
+      print("Device file not found: device" + name + ".py")
+      sys.exit(2)
+   MCUREGS.clear()
+   MCUREGS.update(device.MCUREGS)
+
+def parse_args():
+   parser = argparse.ArgumentParser(description="A Python shell for communicating with Forth systems via serial communications")
+   parser.add_argument("-p","--port",help="Serial port or URL e.g. socket://host:2000 or rfc2217://host:2000 (default: " + portName + ")")
+   parser.add_argument("-s","--speed",help="Serial port speed (default: " + portSpeed + ")")
+   parser.add_argument("-d","--device",help="Device register file to use e.g. 328p for device328p.py (default: 328p)")
+   parser.add_argument("-b","--batch",nargs="+",metavar="ITEM",help="Run '#' commands and upload files without the keyboard, then exit. Status is 0 on success, 1 on failure and 2 if the port can't be opened")
+   parser.add_argument("-c","--config",default="config.ftk",help="Config file of startup commands (default: config.ftk)")
+   parser.add_argument("-l","--log",help="Log everything received to a file")
+   parser.add_argument("-r","--record",metavar="TRACE",help="Record all data sent and received to a trace file")
+   parser.add_argument("--replay",metavar="TRACE",help="Replay a trace file in place of the Forth system")
+   parser.add_argument("--fast",action="store_true",help="Replay as fast as possible instead of at the original speed")
+   return parser.parse_args()
+
+if __name__ == "__main__":
+   args = parse_args()
+   if args.device:
+      load_device(args.device)
+   port,speed = config_port(args.config,portName,portSpeed) # Command line overrides config file
+   forthtalk = ForthTalk(args.port or port,args.speed or speed,args.config,args.record,args.replay,args.fast,args.log,args.batch)
+   if args.batch != None:
+      forthtalk.run_batch() # Doesn't return
 
 
 